@@ -51,20 +51,24 @@ class Block:
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce)
 
     def serialize(self):
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
 
+    def serialize_into(self, buf):
 
-        result = int_to_little_endian(self.version, 4)
 
-        result += self.prev_block[::-1]
+        buf += int_to_little_endian(self.version, 4)
 
-        result += self.merkle_root[::-1]
+        buf += self.prev_block[::-1]
 
-        result += int_to_little_endian(self.timestamp, 4)
+        buf += self.merkle_root[::-1]
 
-        result += self.bits
+        buf += int_to_little_endian(self.timestamp, 4)
 
-        result += self.nonce
-        return result
+        buf += self.bits
+
+        buf += self.nonce
 
     def hash(self):
 
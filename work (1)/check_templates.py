@@ -0,0 +1,133 @@
+'''Differential check of evaluate_template against Script.evaluate.
+
+Builds random, mostly malformed P2PKH, P2WPKH, P2SH-P2WPKH and P2WSH
+multisig spends and checks that whenever evaluate_template gives an
+answer, the interpreter gives the same one:
+
+    python check_templates.py [trials] [seed]
+'''
+from contextlib import redirect_stdout
+from io import StringIO
+from logging import CRITICAL, disable
+
+import random
+import sys
+
+from ecc import PrivateKey
+from helper import hash160, sha256
+from script import (
+    evaluate_template,
+    p2pkh_script,
+    p2sh_script,
+    p2wpkh_script,
+    p2wsh_script,
+    Script,
+)
+
+
+def check_tx(tx, prevouts=None):
+    '''Returns the indexes of the inputs of tx where evaluate_template
+    and Script.evaluate disagree'''
+    if prevouts is None:
+        prevouts = tx.resolve_prevouts()
+    mismatches = []
+    for input_index in range(len(tx.tx_ins)):
+        script_sig, script_pubkey, z, witness = tx.input_program(input_index, prevouts)
+        result = evaluate_template(script_sig, script_pubkey, z, witness)
+        combined = script_sig + script_pubkey
+        if result is not None and result != combined.evaluate(z, witness):
+            mismatches.append(input_index)
+    return mismatches
+
+
+def multisig_script(m, sec_pubkeys):
+    return Script([80 + m] + sec_pubkeys + [80 + len(sec_pubkeys), 0xae]).raw_serialize()
+
+
+def random_spend(rng, secs, sigs):
+    '''(script_sig, script_pubkey, witness) of one random spend'''
+    junk = [b'', b'\x00', b'\x30\x01', bytes(20), bytes(32), b'\x02' + bytes(32)]
+
+    def item():
+        return rng.choice(sigs + secs + junk + [0])
+
+    sec = rng.choice(secs)
+    sig = rng.choice(sigs)
+    kind = rng.randrange(4)
+    if kind == 0:
+        script_pubkey = p2pkh_script(hash160(rng.choice(secs)))
+        script_sig = Script(rng.choice([
+            [sig, sec], [sig], [sig, sec, sec], [b'', sec], [0, sec], [item(), item()]]))
+        return script_sig, script_pubkey, None
+    if kind == 1:
+        script_pubkey = p2wpkh_script(hash160(rng.choice(secs)))
+        script_sig = Script(rng.choice([[], [], [b'\x01']]))
+        witness = rng.choice([
+            [sig, sec], [sig], [0, sec], [item(), item()], [sig, sec, sig]])
+        return script_sig, script_pubkey, witness
+    if kind == 2:
+        redeem_script = p2wpkh_script(hash160(rng.choice(secs))).raw_serialize()
+        script_pubkey = p2sh_script(hash160(rng.choice([redeem_script, redeem_script, b'x'])))
+        script_sig = Script(rng.choice([
+            [redeem_script], [redeem_script], [redeem_script, redeem_script],
+            [b'\x00\x14' + bytes(19)]]))
+        witness = rng.choice([[sig, sec], [item(), item()], [sig]])
+        return script_sig, script_pubkey, witness
+    n = rng.randint(1, 3)
+    sec_pubkeys = rng.sample(secs, n)
+    m = rng.randint(1, n + 1)
+    witness_script = rng.choice([
+        multisig_script(m, sec_pubkeys), multisig_script(m, sec_pubkeys),
+        b'\x51\xae', Script([81, 0xac]).raw_serialize(), b'\x4c'])
+    script_pubkey = p2wsh_script(sha256(rng.choice([witness_script, witness_script, b'x'])))
+    witness = [rng.choice([0, b'', sig, item()])] \
+        + [rng.choice(sigs + junk) for _ in range(rng.randint(0, 3))] \
+        + [witness_script]
+    script_sig = Script(rng.choice([[], [], [b'\x01']]))
+    return script_sig, script_pubkey, witness
+
+
+def outcome(evaluate, *args):
+    try:
+        # the interpreter prints some failures
+        with redirect_stdout(StringIO()):
+            return evaluate(*args)
+    except Exception as e:
+        return type(e).__name__
+
+
+def run(trials=6000, seed=7):
+    '''Returns (number of spends the templates decided, mismatches), each
+    mismatch being (script_sig, script_pubkey, witness, template result,
+    interpreter result)'''
+    rng = random.Random(seed)
+    z = 12345
+    keys = [PrivateKey(rng.randrange(1, 2**255)) for _ in range(3)]
+    secs = [key.point.sec() for key in keys] + [keys[0].point.sec(False)]
+    sigs = [key.sign(z).der() + b'\x01' for key in keys] \
+        + [keys[0].sign(z + 1).der() + b'\x01']
+    decided = 0
+    mismatches = []
+    for _ in range(trials):
+        script_sig, script_pubkey, witness = random_spend(rng, secs, sigs)
+        result = outcome(evaluate_template, script_sig, script_pubkey, z, witness)
+        if result is None:
+            continue
+        decided += 1
+        expected = outcome((script_sig + script_pubkey).evaluate, z, witness)
+        if result != expected:
+            mismatches.append((script_sig, script_pubkey, witness, result, expected))
+    return decided, mismatches
+
+
+if __name__ == '__main__':
+    disable(CRITICAL)
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    decided, mismatches = run(trials, seed)
+    for script_sig, script_pubkey, witness, result, expected in mismatches:
+        print('mismatch: {} | {} | {}: template {}, interpreter {}'.format(
+            script_sig, script_pubkey, witness, result, expected))
+    print('{} spends, {} decided by templates, {} mismatches'.format(
+        trials, decided, len(mismatches)))
+    sys.exit(1 if mismatches else 0)
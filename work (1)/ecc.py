@@ -1,13 +1,21 @@
 from io import BytesIO
-from random import randint
+from logging import getLogger
+from random import randint, randrange
+from tempfile import mkstemp
+from threading import Lock
 
 import hashlib
 import hmac
+import os
 
-from helper import encode_base58_checksum, hash160
+from helper import encode_base58_checksum, hash160, LRUCache
+
+
+LOGGER = getLogger(__name__)
 
 
 class FieldElement:
+    __slots__ = ('num', 'prime')
 
     def __init__(self, num, prime):
         if num >= prime or num < 0:
@@ -17,6 +25,15 @@ class FieldElement:
         self.num = num
         self.prime = prime
 
+    @classmethod
+    def _trusted(cls, num, prime):
+        '''Builds an element from an already reduced num, skipping the
+        range check. Only for results of field arithmetic.'''
+        element = object.__new__(cls)
+        element.num = num
+        element.prime = prime
+        return element
+
     def __repr__(self):
         return 'FieldElement_{}({})'.format(self.prime, self.num)
 
@@ -36,7 +53,7 @@ class FieldElement:
 
         num = (self.num + other.num) % self.prime
 
-        return self.__class__(num, self.prime)
+        return self._trusted(num, self.prime)
 
     def __sub__(self, other):
         if self.prime != other.prime:
@@ -45,7 +62,7 @@ class FieldElement:
 
         num = (self.num - other.num) % self.prime
 
-        return self.__class__(num, self.prime)
+        return self._trusted(num, self.prime)
 
     def __mul__(self, other):
         if self.prime != other.prime:
@@ -54,12 +71,12 @@ class FieldElement:
 
         num = (self.num * other.num) % self.prime
 
-        return self.__class__(num, self.prime)
+        return self._trusted(num, self.prime)
 
     def __pow__(self, exponent):
         n = exponent % (self.prime - 1)
         num = pow(self.num, n, self.prime)
-        return self.__class__(num, self.prime)
+        return self._trusted(num, self.prime)
 
     def __truediv__(self, other):
         if self.prime != other.prime:
@@ -72,15 +89,16 @@ class FieldElement:
 
         num = (self.num * pow(other.num, self.prime - 2, self.prime)) % self.prime
 
-        return self.__class__(num, self.prime)
+        return self._trusted(num, self.prime)
 
     def __rmul__(self, coefficient):
         num = (self.num * coefficient) % self.prime
-        return self.__class__(num=num, prime=self.prime)
+        return self._trusted(num, self.prime)
 
 
 
 class Point:
+    __slots__ = ('x', 'y', 'a', 'b')
 
     def __init__(self, x, y, a, b):
         self.a = a
@@ -98,6 +116,17 @@ class Point:
 
             raise ValueError('({}, {}) is not on the curve'.format(x, y))
 
+    @classmethod
+    def _trusted(cls, x, y, a, b):
+        '''Builds a point known to be on the curve, skipping the curve
+        equation check. Only for results of point arithmetic.'''
+        point = object.__new__(cls)
+        point.x = x
+        point.y = y
+        point.a = a
+        point.b = b
+        return point
+
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y \
             and self.a == other.a and self.b == other.b
@@ -127,7 +156,7 @@ class Point:
 
 
         if self.x == other.x and self.y != other.y:
-            return self.__class__(None, None, self.a, self.b)
+            return self._trusted(None, None, self.a, self.b)
 
 
 
@@ -137,13 +166,13 @@ class Point:
             s = (other.y - self.y) / (other.x - self.x)
             x = s**2 - self.x - other.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            return self._trusted(x, y, self.a, self.b)
 
 
 
 
         if self == other and self.y == 0 * self.x:
-            return self.__class__(None, None, self.a, self.b)
+            return self._trusted(None, None, self.a, self.b)
 
 
 
@@ -153,12 +182,12 @@ class Point:
             s = (3 * self.x**2 + self.a) / (2 * self.y)
             x = s**2 - 2 * self.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            return self._trusted(x, y, self.a, self.b)
 
     def __rmul__(self, coefficient):
         coef = coefficient
         current = self
-        result = self.__class__(None, None, self.a, self.b)
+        result = self._trusted(None, None, self.a, self.b)
         while coef:
             if coef & 1:
                 result += current
@@ -179,7 +208,242 @@ P = 2**256 - 2**32 - 977
 N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
 
+# Jacobian coordinates: (X, Y, Z) stands for the affine point
+# (X / Z**2, Y / Z**3). All values are plain ints mod P and Z == 0 is the
+# point at infinity, so adding and doubling never need an inversion.
+_JACOBIAN_INFINITY = (0, 1, 0)
+
+# GLV endomorphism: (x, y) -> (beta * x, y) is the same as multiplying by
+# lambda, so a 256-bit scalar k can be split into k1 + k2 * lambda with
+# k1 and k2 of about 128 bits each, halving the doublings. Set USE_GLV to
+# False to run every multiplication through the plain reference ladder.
+USE_GLV = True
+_GLV_BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+_GLV_LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+_GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+_GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+_GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+_GLV_B2 = 0x3086d221a7d46bcde86c90e49284eb15
+
+
+def _jacobian_double(p):
+    x1, y1, z1 = p
+    if z1 == 0 or y1 == 0:
+        return _JACOBIAN_INFINITY
+    yy = y1 * y1 % P
+    s = 4 * x1 * yy % P
+    m = 3 * x1 * x1 % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    z3 = 2 * y1 * z1 % P
+    return (x3, y3, z3)
+
+
+def _jacobian_add(p, q):
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    if z1 == 0:
+        return q
+    if z2 == 0:
+        return p
+    z1z1 = z1 * z1 % P
+    if z2 == 1:
+        # mixed addition, q is affine
+        u1, s1 = x1, y1
+        u2 = x2 * z1z1 % P
+        s2 = y2 * z1 * z1z1 % P
+    else:
+        z2z2 = z2 * z2 % P
+        u1 = x1 * z2z2 % P
+        s1 = y1 * z2 * z2z2 % P
+        u2 = x2 * z1z1 % P
+        s2 = y2 * z1 * z1z1 % P
+    if u1 == u2:
+        if s1 != s2:
+            return _JACOBIAN_INFINITY
+        return _jacobian_double(p)
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = h * z1 * z2 % P
+    return (x3, y3, z3)
+
+
+def _jacobian_negate(p):
+    x, y, z = p
+    return (x, (P - y) % P, z)
+
+
+def _wnaf(coefficient, width):
+    '''Returns the width-w non-adjacent form of coefficient, least
+    significant digit first. Every non-zero digit is odd and smaller than
+    2**(width - 1) in absolute value.'''
+    digits = []
+    window = 1 << width
+    half = window >> 1
+    while coefficient:
+        if coefficient & 1:
+            digit = coefficient & (window - 1)
+            if digit >= half:
+                digit -= window
+            coefficient -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        coefficient >>= 1
+    return digits
+
+
+def _odd_multiples(p, width):
+    '''Returns [p, 3p, 5p, ..., (2**(width - 1) - 1)p]'''
+    result = [p]
+    twice = _jacobian_double(p)
+    for _ in range((1 << (width - 2)) - 1):
+        result.append(_jacobian_add(result[-1], twice))
+    return result
+
+
+def _jacobian_multi_multiply(terms):
+    '''Strauss-Shamir interleaving: terms is a list of
+    (odd multiples table, width, coefficient) and the result is the sum of
+    every coefficient times its point, sharing one chain of doublings.
+    Coefficients may be negative.'''
+    expansions = []
+    for table, width, coefficient in terms:
+        if coefficient > 0:
+            expansions.append((table, _wnaf(coefficient, width)))
+        elif coefficient < 0:
+            digits = [-digit for digit in _wnaf(-coefficient, width)]
+            expansions.append((table, digits))
+    if not expansions:
+        return _JACOBIAN_INFINITY
+    result = _JACOBIAN_INFINITY
+    for i in range(max(len(digits) for _, digits in expansions) - 1, -1, -1):
+        result = _jacobian_double(result)
+        for table, digits in expansions:
+            if i >= len(digits):
+                continue
+            digit = digits[i]
+            if digit > 0:
+                result = _jacobian_add(result, table[digit >> 1])
+            elif digit < 0:
+                result = _jacobian_add(result, _jacobian_negate(table[-digit >> 1]))
+    return result
+
+
+def _glv_split(coefficient):
+    '''Returns (k1, k2) with k1 + k2 * lambda == coefficient mod N'''
+    c1 = (_GLV_B2 * coefficient + N // 2) // N
+    c2 = (-_GLV_B1 * coefficient + N // 2) // N
+    k1 = coefficient - c1 * _GLV_A1 - c2 * _GLV_A2
+    k2 = -c1 * _GLV_B1 - c2 * _GLV_B2
+    return k1, k2
+
+
+def _endomorphism(table):
+    return [(_GLV_BETA * x % P, y, z) for x, y, z in table]
+
+
+def _glv_terms(tables, width, coefficient):
+    '''tables is (odd multiples of p, odd multiples of lambda * p)'''
+    k1, k2 = _glv_split(coefficient)
+    return [(tables[0], width, k1), (tables[1], width, k2)]
+
+
+def _jacobian_ladder(p, coefficient):
+    '''Reference double-and-add, kept to cross-check the fast paths'''
+    result = _JACOBIAN_INFINITY
+    for bit in bin(coefficient)[2:]:
+        result = _jacobian_double(result)
+        if bit == '1':
+            result = _jacobian_add(result, p)
+    return result
+
+
+def _jacobian_multiply(p, coefficient, width=5):
+    if not USE_GLV:
+        return _jacobian_ladder(p, coefficient)
+    table = _odd_multiples(p, width)
+    return _jacobian_multi_multiply(
+        _glv_terms((table, _endomorphism(table)), width, coefficient))
+
+
+def _x_matches(total, r):
+    '''Whether the affine x of a Jacobian point equals r, computed
+    without an inversion'''
+    x, _, z = total
+    if z == 0 or r >= P:
+        return False
+    return x == r * z * z % P
+
+
+def _verification_tables(point):
+    '''Width-5 odd multiples of point and of lambda * point'''
+    table = _jacobian_normalize(_odd_multiples(point._jacobian(), 5))
+    return table, _endomorphism(table)
+
+
+def _verification_sum(u, point, v, tables=None):
+    '''u * G + v * point, optionally reusing _verification_tables(point)'''
+    if not USE_GLV:
+        return _jacobian_add(_jacobian_ladder(G._jacobian(), u),
+                             _jacobian_ladder(point._jacobian(), v))
+    if tables is None:
+        tables = _verification_tables(point)
+    return _jacobian_multi_multiply(
+        _glv_terms(GeneratorTable.get_odd_multiples(), GeneratorTable.naf_width, u)
+        + _glv_terms(tables, 5, v))
+
+
+def batch_inverse(values, modulus=P):
+    '''Takes a list of ints and returns their inverses mod modulus (P for
+    field elements, N for scalars). Uses Montgomery's trick, so k values
+    cost one modular inversion and about 3k multiplications. Raises
+    ValueError if any value is 0 mod modulus.'''
+    prefix = []
+    acc = 1
+    for value in values:
+        prefix.append(acc)
+        acc = acc * value % modulus
+    acc_inv = pow(acc, -1, modulus)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        result[i] = acc_inv * prefix[i] % modulus
+        acc_inv = acc_inv * values[i] % modulus
+    return result
+
+
+def _jacobian_to_affine(p):
+    x, y, z = p
+    if z == 0:
+        return None, None
+    if z == 1:
+        return x, y
+    z_inv = pow(z, -1, P)
+    z_inv2 = z_inv * z_inv % P
+    return x * z_inv2 % P, y * z_inv2 * z_inv % P
+
+
+def _jacobian_normalize(points):
+    '''Rescales a list of Jacobian points to Z == 1 with one shared
+    inversion so later additions can take the mixed path. The point at
+    infinity is left as it is.'''
+    indexes = [i for i, p in enumerate(points) if p[2] not in (0, 1)]
+    z_invs = batch_inverse([points[i][2] for i in indexes])
+    result = list(points)
+    for i, z_inv in zip(indexes, z_invs):
+        x, y, _ = points[i]
+        z_inv2 = z_inv * z_inv % P
+        result[i] = (x * z_inv2 % P, y * z_inv2 * z_inv % P, 1)
+    return result
+
+
 class S256Field(FieldElement):
+    __slots__ = ()
 
     def __init__(self, num, prime=None):
         super().__init__(num=num, prime=P)
@@ -191,10 +455,16 @@ class S256Field(FieldElement):
         return self**((P + 1) // 4)
 
 
+_S256_A = S256Field(A)
+_S256_B = S256Field(B)
+
+
 class S256Point(Point):
+    __slots__ = ()
+    parse_cache = LRUCache(4096)
 
     def __init__(self, x, y, a=None, b=None):
-        a, b = S256Field(A), S256Field(B)
+        a, b = _S256_A, _S256_B
         if type(x) == int:
             super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
         else:
@@ -208,7 +478,26 @@ class S256Point(Point):
 
     def __rmul__(self, coefficient):
         coef = coefficient % N
-        return super().__rmul__(coef)
+        if self._is_generator() and USE_GLV:
+            return self._from_jacobian(GeneratorTable.multiply(coef))
+        return self._from_jacobian(_jacobian_multiply(self._jacobian(), coef))
+
+    def _is_generator(self):
+        return self.x is not None and self.x.num == G.x.num \
+            and self.y.num == G.y.num
+
+    def _jacobian(self):
+        if self.x is None:
+            return _JACOBIAN_INFINITY
+        return (self.x.num, self.y.num, 1)
+
+    @classmethod
+    def _from_jacobian(cls, p):
+        x, y = _jacobian_to_affine(p)
+        if x is None:
+            return cls._trusted(None, None, _S256_A, _S256_B)
+        return cls._trusted(S256Field._trusted(x, P), S256Field._trusted(y, P),
+                            _S256_A, _S256_B)
 
     def verify(self, z, sig):
 
@@ -218,8 +507,8 @@ class S256Point(Point):
 
         v = sig.r * s_inv % N
 
-        total = u * G + v * self
-        return total.x.num == sig.r
+        total = _verification_sum(u, self, v)
+        return _x_matches(total, sig.r)
 
     def sec(self, compressed=True):
 
@@ -249,7 +538,16 @@ class S256Point(Point):
         return encode_base58_checksum(prefix + h160)
 
     @classmethod
-    def parse(self, sec_bin):
+    def parse(cls, sec_bin):
+        key = bytes(sec_bin)
+        point = cls.parse_cache.get(key)
+        if point is None:
+            point = cls._parse(key)
+            cls.parse_cache[key] = point
+        return point
+
+    @classmethod
+    def _parse(self, sec_bin):
 
         if sec_bin[0] == 4:
             x = int.from_bytes(sec_bin[1:33], 'big')
@@ -258,7 +556,7 @@ class S256Point(Point):
         is_even = sec_bin[0] == 2
         x = S256Field(int.from_bytes(sec_bin[1:], 'big'))
 
-        alpha = x**3 + S256Field(B)
+        alpha = x**3 + _S256_B
 
         beta = alpha.sqrt()
         if beta.num % 2 == 0:
@@ -278,8 +576,125 @@ G = S256Point(
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8)
 
 
+class GeneratorTable:
+    '''Fixed-base comb for G. Window i holds d * 2**(width * i) * G for
+    every non-zero digit d, so k * G is one mixed addition per window and
+    no doublings. The table is built on first use; set cache_file to
+    reuse it across processes.'''
+
+    width = 8
+    cache_file = None
+    table = None
+    naf_width = 8
+    odd_multiples = None
+
+    @classmethod
+    def windows(cls):
+        return (256 + cls.width - 1) // cls.width
+
+    @classmethod
+    def build(cls):
+        row_size = (1 << cls.width) - 1
+        points = []
+        base = G._jacobian()
+        for _ in range(cls.windows()):
+            current = base
+            for _ in range(row_size):
+                points.append(current)
+                current = _jacobian_add(current, base)
+            base = current
+        points = _jacobian_normalize(points)
+        cls.table = [points[i:i + row_size]
+                     for i in range(0, len(points), row_size)]
+        return cls.table
+
+    @classmethod
+    def get(cls):
+        if cls.table is None:
+            if cls.cache_file and os.path.exists(cls.cache_file):
+                try:
+                    cls.load_cache(cls.cache_file)
+                except (OSError, ValueError) as e:
+                    # a truncated or corrupt cache is rebuilt and replaced
+                    LOGGER.info(e)
+            if cls.table is None:
+                cls.build()
+                if cls.cache_file:
+                    try:
+                        cls.dump_cache(cls.cache_file)
+                    except OSError as e:
+                        LOGGER.info(e)
+        return cls.table
+
+    @classmethod
+    def get_odd_multiples(cls):
+        '''Affine odd multiples of G and of lambda * G for interleaved
+        multiplication'''
+        if cls.odd_multiples is None:
+            table = _jacobian_normalize(
+                _odd_multiples(G._jacobian(), cls.naf_width))
+            cls.odd_multiples = (table, _endomorphism(table))
+        return cls.odd_multiples
+
+    @classmethod
+    def load_cache(cls, filename):
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        row_size = (1 << cls.width) - 1
+        if len(raw) != 1 + 64 * row_size * cls.windows() or raw[0] != cls.width:
+            raise ValueError('Generator table in {} does not match width {}'.format(
+                filename, cls.width))
+        table = []
+        offset = 1
+        for _ in range(cls.windows()):
+            row = []
+            for _ in range(row_size):
+                x = int.from_bytes(raw[offset:offset + 32], 'big')
+                y = int.from_bytes(raw[offset + 32:offset + 64], 'big')
+                if (y * y - x * x * x - B) % P != 0:
+                    raise ValueError('Generator table in {} is corrupt'.format(filename))
+                row.append((x, y, 1))
+                offset += 64
+            table.append(row)
+        if table[0][0][:2] != (G.x.num, G.y.num):
+            raise ValueError('Generator table in {} is corrupt'.format(filename))
+        cls.table = table
+
+    @classmethod
+    def dump_cache(cls, filename):
+        result = bytearray([cls.width])
+        for row in cls.get():
+            for x, y, _ in row:
+                result += x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+        # written next to filename and moved into place, so readers never
+        # see a partial table
+        fd, tmp_name = mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(result)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+
+    @classmethod
+    def multiply(cls, coefficient):
+        '''Returns coefficient * G in Jacobian coordinates'''
+        table = cls.get()
+        mask = (1 << cls.width) - 1
+        result = _JACOBIAN_INFINITY
+        for row in table:
+            digit = coefficient & mask
+            if digit:
+                result = _jacobian_add(result, row[digit - 1])
+            coefficient >>= cls.width
+            if not coefficient:
+                break
+        return result
+
 
 class Signature:
+    parse_cache = LRUCache(4096)
 
     def __init__(self, r, s):
         self.r = r
@@ -307,6 +722,15 @@ class Signature:
 
     @classmethod
     def parse(cls, signature_bin):
+        key = bytes(signature_bin)
+        sig = cls.parse_cache.get(key)
+        if sig is None:
+            sig = cls._parse(key)
+            cls.parse_cache[key] = sig
+        return sig
+
+    @classmethod
+    def _parse(cls, signature_bin):
         s = BytesIO(signature_bin)
         compound = s.read(1)[0]
         if compound != 0x30:
@@ -329,6 +753,104 @@ class Signature:
         return cls(r, s)
 
 
+class SignatureCache:
+    '''Remembers (public key, z, signature) triples that verified, in the
+    spirit of Bitcoin Core's signature cache. Entries are keyed by a
+    salted hash and a random entry is evicted when the cache is full.
+    Safe to share between threads.'''
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.salt = os.urandom(32)
+        self.keys = []
+        self.index = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'SignatureCache({}/{}, hits={}, misses={})'.format(
+            len(self.keys), self.max_size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, point, z, sig):
+        data = '{:x}:{:x}:{:x}'.format(z, sig.r, sig.s).encode()
+        return hashlib.sha256(self.salt + point.sec() + data).digest()
+
+    def contains(self, point, z, sig):
+        key = self.key(point, z, sig)
+        with self.lock:
+            if key in self.index:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, point, z, sig):
+        key = self.key(point, z, sig)
+        with self.lock:
+            if key in self.index:
+                return
+            while self.keys and len(self.keys) >= self.max_size:
+                self._evict(randrange(len(self.keys)))
+            if self.max_size > 0:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+
+    def _evict(self, i):
+        last = self.keys.pop()
+        evicted = self.keys[i] if i < len(self.keys) else last
+        del self.index[evicted]
+        if evicted is not last:
+            self.keys[i] = last
+            self.index[last] = i
+
+    def verify(self, point, z, sig):
+        '''point.verify(z, sig), skipping the ECDSA work for triples that
+        already verified'''
+        if self.contains(point, z, sig):
+            return True
+        if point.verify(z, sig):
+            self.add(point, z, sig)
+            return True
+        return False
+
+    def clear(self):
+        with self.lock:
+            self.keys = []
+            self.index = {}
+            self.hits = 0
+            self.misses = 0
+
+
+def verify_batch(items):
+    '''Takes a list of (point, z, signature) and returns a list of bools,
+    one per item. The s inverses are computed together and each distinct
+    public key's precomputation is shared by all of its signatures.'''
+    results = [False] * len(items)
+    pending = [i for i, (point, _, sig) in enumerate(items)
+               if point.x is not None and sig.s % N != 0]
+    s_invs = batch_inverse([items[i][2].s for i in pending], N)
+    tables = {}
+    for i, s_inv in zip(pending, s_invs):
+        point, z, sig = items[i]
+        key = (point.x.num, point.y.num)
+        if key not in tables:
+            tables[key] = _verification_tables(point)
+        u = z * s_inv % N
+        v = sig.r * s_inv % N
+        total = _verification_sum(u, point, v, tables[key])
+        results[i] = _x_matches(total, sig.r)
+    return results
+
+
+def _hmac_digest(keyed, data):
+    '''Finishes a copy of an already keyed HMAC object over data'''
+    h = keyed.copy()
+    h.update(data)
+    return h.digest()
 
 
 class PrivateKey:
@@ -336,43 +858,62 @@ class PrivateKey:
     def __init__(self, secret):
         self.secret = secret
         self.point = secret * G
+        self._rfc6979 = None
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
     def sign(self, z):
-        k = self.deterministic_k(z)
-
-        r = (k * G).x.num
-
-        k_inv = pow(k, N - 2, N)
-
-        s = (z + r * self.secret) * k_inv % N
-        if s > N / 2:
-            s = N - s
-
-
-        return Signature(r, s)
+        return self.sign_many([z])[0]
+
+    def sign_many(self, zs):
+        '''Signs every z in zs, sharing one inversion for all the nonce
+        points and one for all the nonces'''
+        ks = [self.deterministic_k(z) for z in zs]
+        points = [GeneratorTable.multiply(k) for k in ks]
+        z_invs = batch_inverse([p[2] for p in points])
+        k_invs = batch_inverse(ks, N)
+        sigs = []
+        for z, k_inv, point, z_inv in zip(zs, k_invs, points, z_invs):
+            r = point[0] * z_inv * z_inv % P
+
+            s = (z + r * self.secret) * k_inv % N
+            if s > N / 2:
+                s = N - s
+
+            sigs.append(Signature(r, s))
+        return sigs
+
+    def _rfc6979_state(self):
+        '''The private key bytes and the first RFC 6979 HMAC, keyed with
+        the all-zero K and already fed V || 0x00 || secret'''
+        if self._rfc6979 is None:
+            secret_bytes = self.secret.to_bytes(32, 'big')
+            first = hmac.new(b'\x00' * 32, b'\x01' * 32 + b'\x00' + secret_bytes,
+                             hashlib.sha256)
+            self._rfc6979 = (secret_bytes, first)
+        return self._rfc6979
 
     def deterministic_k(self, z):
-        k = b'\x00' * 32
         v = b'\x01' * 32
         if z > N:
             z -= N
         z_bytes = z.to_bytes(32, 'big')
-        secret_bytes = self.secret.to_bytes(32, 'big')
-        s256 = hashlib.sha256
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
+        secret_bytes, first = self._rfc6979_state()
+        k = _hmac_digest(first, z_bytes)
+        keyed = hmac.new(k, digestmod=hashlib.sha256)
+        v = _hmac_digest(keyed, v)
+        k = _hmac_digest(keyed, v + b'\x01' + secret_bytes + z_bytes)
+        keyed = hmac.new(k, digestmod=hashlib.sha256)
+        v = _hmac_digest(keyed, v)
         while True:
-            v = hmac.new(k, v, s256).digest()
+            v = _hmac_digest(keyed, v)
             candidate = int.from_bytes(v, 'big')
             if candidate >= 1 and candidate < N:
                 return candidate
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+            k = _hmac_digest(keyed, v + b'\x00')
+            keyed = hmac.new(k, digestmod=hashlib.sha256)
+            v = _hmac_digest(keyed, v)
 
     def wif(self, compressed=True, testnet=False):
 
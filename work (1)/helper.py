@@ -1,10 +1,14 @@
 
+from collections import OrderedDict
+from threading import Lock
+
 import hashlib
 
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 TWO_WEEKS = 60 * 60 * 24 * 14
 MAX_TARGET = 0xffff * 256**(0x1d - 3)
@@ -91,6 +95,19 @@ def read_varint(s):
         return i
 
 
+def read_varint_at(buf, offset):
+    '''read_varint over a buffer, returns (value, offset after it)'''
+    i = buf[offset]
+    if i == 0xfd:
+        return little_endian_to_int(buf[offset + 1:offset + 3]), offset + 3
+    elif i == 0xfe:
+        return little_endian_to_int(buf[offset + 1:offset + 5]), offset + 5
+    elif i == 0xff:
+        return little_endian_to_int(buf[offset + 1:offset + 9]), offset + 9
+    else:
+        return i, offset + 1
+
+
 def encode_varint(i):
 
     if i < 0xfd:
@@ -280,3 +297,106 @@ def murmur3(data, seed=0):
     return h1 & 0xffffffff
 
 
+class LRUCache:
+    '''Bounded mapping that evicts the least recently used entry once it
+    holds more than max_size items, or once the sizes of its values
+    (measured with sizeof) add up to more than max_bytes. Either limit can
+    be None. Safe to share between threads.'''
+
+    def __init__(self, max_size=1024, max_bytes=None, sizeof=len):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return 'LRUCache({}/{}, hits={}, misses={}, evictions={})'.format(
+            len(self), self.max_size, self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if self.max_bytes is not None:
+                size = self.sizeof(value)
+                self.total_bytes += size - self.sizes.get(key, 0)
+                self.sizes[key] = size
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while self._over_limit():
+                oldest, _ = self.entries.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(oldest, 0)
+                self.evictions += 1
+
+    def _over_limit(self):
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            return True
+        # the newest entry is kept even if it is larger than max_bytes
+        return self.max_bytes is not None and len(self.entries) > 1 \
+            and self.total_bytes > self.max_bytes
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.total_bytes -= self.sizes.pop(key, 0)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key]
+            self._remove(key)
+            return value
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
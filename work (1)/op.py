@@ -5,6 +5,7 @@ from logging import getLogger
 from ecc import (
     S256Point,
     Signature,
+    SignatureCache,
 )
 
 from helper import (
@@ -15,6 +16,9 @@ from helper import (
 
 LOGGER = getLogger(__name__)
 
+# shared by every script evaluation; resize with SIG_CACHE.max_size
+SIG_CACHE = SignatureCache()
+
 
 def encode_num(num):
     if num == 0:
@@ -153,17 +157,15 @@ def op_nop(stack):
     return True
 
 
-def op_if(stack, items):
-    if len(stack) < 1:
-        return False
-
+def split_branches(items):
+    '''Removes the commands up to the matching OP_ENDIF from items and
+    returns them as (true_items, false_items), or None without an
+    OP_ENDIF'''
     true_items = []
     false_items = []
     current_array = true_items
-    found = False
     num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
+    for i, item in enumerate(items):
         if item in (99, 100):
 
             num_endifs_needed += 1
@@ -172,15 +174,24 @@ def op_if(stack, items):
             current_array = false_items
         elif item == 104:
             if num_endifs_needed == 1:
-                found = True
-                break
+                del items[:i + 1]
+                return true_items, false_items
             else:
                 num_endifs_needed -= 1
                 current_array.append(item)
         else:
             current_array.append(item)
-    if not found:
+    del items[:]
+    return None
+
+
+def op_if(stack, items):
+    if len(stack) < 1:
+        return False
+    branches = split_branches(items)
+    if branches is None:
         return False
+    true_items, false_items = branches
     element = stack.pop()
     if decode_num(element) == 0:
         items[:0] = false_items
@@ -192,31 +203,10 @@ def op_if(stack, items):
 def op_notif(stack, items):
     if len(stack) < 1:
         return False
-
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
+    branches = split_branches(items)
+    if branches is None:
         return False
+    true_items, false_items = branches
     element = stack.pop()
     if decode_num(element) == 0:
         items[:0] = true_items
@@ -658,7 +648,7 @@ def op_hash256(stack):
     return True
 
 
-def op_checksig(stack, z):
+def op_checksig(stack, z, batch=None):
 
     if len(stack) < 2:
         return False
@@ -675,19 +665,25 @@ def op_checksig(stack, z):
         LOGGER.info(e)
         return False
 
+    if batch is not None:
+        # assume success and let the caller check the whole batch later
+        if not SIG_CACHE.contains(point, z, sig):
+            batch.append((point, z, sig))
+        stack.append(encode_num(1))
+        return True
 
-    if point.verify(z, sig):
+    if SIG_CACHE.verify(point, z, sig):
         stack.append(encode_num(1))
     else:
         stack.append(encode_num(0))
     return True
 
 
-def op_checksigverify(stack, z):
-    return op_checksig(stack, z) and op_verify(stack)
+def op_checksigverify(stack, z, batch=None):
+    return op_checksig(stack, z, batch) and op_verify(stack)
 
 
-def op_checkmultisig(stack, z):
+def op_checkmultisig(stack, z, batch=None):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
@@ -711,6 +707,16 @@ def op_checkmultisig(stack, z):
 
         sigs = [Signature.parse(der) for der in der_signatures]
 
+        if batch is not None and len(sigs) == len(points):
+            # n-of-n: every key signs, so signature i belongs to key i.
+            # Otherwise which keys signed is only known by trying them,
+            # so those are checked serially below
+            for point, sig in zip(points, sigs):
+                if not SIG_CACHE.contains(point, z, sig):
+                    batch.append((point, z, sig))
+            stack.append(encode_num(1))
+            return True
+
         for sig in sigs:
 
             if len(points) == 0:
@@ -721,7 +727,7 @@ def op_checkmultisig(stack, z):
 
                 point = points.pop(0)
 
-                if point.verify(z, sig):
+                if SIG_CACHE.verify(point, z, sig):
                     break
 
         stack.append(encode_num(1))
@@ -730,8 +736,8 @@ def op_checkmultisig(stack, z):
     return True
 
 
-def op_checkmultisigverify(stack, z):
-    return op_checkmultisig(stack, z) and op_verify(stack)
+def op_checkmultisigverify(stack, z, batch=None):
+    return op_checkmultisig(stack, z, batch) and op_verify(stack)
 
 
 def op_checklocktimeverify(stack, locktime, sequence):
@@ -1,17 +1,22 @@
-from io import BytesIO
 from logging import getLogger
+from time import perf_counter
 
 from helper import (
     decode_base58,
     encode_varint,
     h160_to_p2pkh_address,
     h160_to_p2sh_address,
+    hash160,
     int_to_little_endian,
     little_endian_to_int,
+    LRUCache,
     read_varint,
+    read_varint_at,
     sha256,
 )
 from op import (
+    decode_num,
+    encode_num,
     op_equal,
     op_hash160,
     op_verify,
@@ -20,6 +25,92 @@ from op import (
 )
 
 
+# calling conventions of the functions in OP_CODE_FUNCTIONS
+PLAIN_OP = 0
+SIGNATURE_OP = 1
+ALTSTACK_OP = 2
+BRANCH_OP = 3
+
+
+def op_code_dispatch():
+    '''Maps every opcode to (calling convention, function)'''
+    result = {}
+    for cmd, operation in OP_CODE_FUNCTIONS.items():
+        if cmd in (99, 100):
+            result[cmd] = (BRANCH_OP, operation)
+        elif cmd in (107, 108):
+            result[cmd] = (ALTSTACK_OP, operation)
+        elif cmd in (172, 173, 174, 175):
+            result[cmd] = (SIGNATURE_OP, operation)
+        else:
+            result[cmd] = (PLAIN_OP, operation)
+    return result
+
+
+OP_CODE_DISPATCH = op_code_dispatch()
+
+
+def branch_map(cmds, start=0):
+    '''Matches every OP_IF/OP_NOTIF from start on with its OP_ELSEs and
+    OP_ENDIF. Returns (branches, markers): branches maps the position of
+    an OP_IF/OP_NOTIF to where its false branch starts, markers maps the
+    position of each of its OP_ELSEs and its OP_ENDIF to (position of
+    the OP_IF, where to continue). As in op_if, the first OP_ELSE ends
+    the true branch and any further OP_ELSE is skipped.'''
+    branches = {}
+    markers = {}
+    if 99 not in cmds and 100 not in cmds:
+        return branches, markers
+    open_ifs = []
+    for pos in range(start, len(cmds)):
+        cmd = cmds[pos]
+        if type(cmd) != int:
+            continue
+        if cmd == 99 or cmd == 100:
+            open_ifs.append((pos, []))
+        elif cmd == 103 and open_ifs:
+            open_ifs[-1][1].append(pos)
+        elif cmd == 104 and open_ifs:
+            if_pos, elses = open_ifs.pop()
+            if elses:
+                branches[if_pos] = elses[0] + 1
+                markers[elses[0]] = (if_pos, pos + 1)
+                for else_pos in elses[1:]:
+                    markers[else_pos] = (if_pos, else_pos + 1)
+            else:
+                branches[if_pos] = pos + 1
+            markers[pos] = (if_pos, pos + 1)
+    return branches, markers
+
+
+def extend_branch_map(cmds, pc, branches, markers):
+    '''Updates the maps after cmds was extended. OP_IFs that are not
+    executed yet are matched again, since the new commands may close
+    them.'''
+    new_branches, new_markers = branch_map(cmds, pc)
+    branches.update(new_branches)
+    markers.update(new_markers)
+    return branches, markers
+
+
+def remaining_cmds(cmds, pc, markers, limit):
+    '''Up to limit of the commands that will run from pc on when no
+    more OP_IFs are taken, which is what op_if leaves in the command list'''
+    if not markers:
+        return cmds[pc:pc + limit]
+    result = []
+    pos = pc
+    while pos < len(cmds) and len(result) < limit:
+        marker = markers.get(pos)
+        if marker is not None and marker[0] < pc:
+            # OP_ELSE/OP_ENDIF of an OP_IF that already ran
+            pos = marker[1]
+        else:
+            result.append(cmds[pos])
+            pos += 1
+    return result
+
+
 def p2pkh_script(h160):
     '''Takes a hash160 and returns the p2pkh ScriptPubKey'''
     return Script([0x76, 0xa9, h160, 0x88, 0xac])
@@ -45,15 +136,210 @@ def p2wsh_script(h256):
 
 
 LOGGER = getLogger(__name__)
+# raw scriptPubKey, redeem or witness script -> [cmds, template], see
+# script_entry; scriptSigs rarely repeat and are not kept
+SCRIPT_CACHE = LRUCache(16384)
+
+
+def decode_cmds(raw):
+    '''Decodes a raw script (without the length prefix) into its list of
+    cmds: ints for opcodes and bytes for pushed elements.'''
+    # initialize the cmds array
+    cmds = []
+    offset = 0
+    length = len(raw)
+    # loop until we've read length bytes
+    while offset < length:
+        # get the current byte
+        current_byte = raw[offset]
+        offset += 1
+        # if the current byte is between 1 and 75 inclusive
+        if current_byte >= 1 and current_byte <= 75:
+            # we have an cmd set n to be the current byte
+            n = current_byte
+        elif current_byte == 76:
+            # op_pushdata1
+            if offset + 1 > length:
+                raise SyntaxError('parsing script failed')
+            n = raw[offset]
+            offset += 1
+        elif current_byte == 77:
+            # op_pushdata2
+            if offset + 2 > length:
+                raise SyntaxError('parsing script failed')
+            n = little_endian_to_int(raw[offset:offset + 2])
+            offset += 2
+        else:
+            # we have an opcode. add it to the list of cmds
+            cmds.append(current_byte)
+            continue
+        # add the next n bytes as an cmd
+        cmds.append(raw[offset:offset + n])
+        offset += n
+    if offset != length:
+        raise SyntaxError('parsing script failed')
+    return cmds
+
+
+def script_entry(raw):
+    '''[cmds] or [cmds, template] of a raw script, from SCRIPT_CACHE
+    when it was seen before'''
+    entry = SCRIPT_CACHE.get(raw)
+    if entry is None:
+        entry = [tuple(decode_cmds(raw))]
+        SCRIPT_CACHE[raw] = entry
+    return entry
+
+
+def decode_script(raw):
+    '''The cmds of a raw script that is expected to repeat, as a tuple'''
+    return script_entry(raw)[0]
+
+
+def script_template(raw):
+    ''''p2pkh', 'p2sh', 'p2wpkh', 'p2wsh' or None for a raw script. It
+    is worked out the first time it is asked for and kept with the cmds.'''
+    entry = script_entry(raw)
+    if len(entry) == 1:
+        script = Script(list(entry[0]))
+        if script.is_p2pkh_script_pubkey():
+            template = 'p2pkh'
+        elif script.is_p2sh_script_pubkey():
+            template = 'p2sh'
+        elif script.is_p2wpkh_script_pubkey():
+            template = 'p2wpkh'
+        elif script.is_p2wsh_script_pubkey():
+            template = 'p2wsh'
+        else:
+            template = None
+        entry.append(template)
+    return entry[1]
+
+
+class ScriptProfiler:
+    '''Counts and times what script validation spends its time on: every
+    opcode the interpreter runs, every input by the template of the
+    script_pubkey it spends, and the sighash and signature check time of
+    each input. Nothing is measured unless a profiler is active:
+
+        with ScriptProfiler() as profiler:
+            for tx in txs:
+                tx.verify()
+        print(profiler.report())
+
+    hook, when given, is called as hook(kind, name, elapsed) for every
+    measurement, kind being 'op', 'template', 'sighash' or 'signature'.
+    Pushes and OP_IF/OP_NOTIF/OP_ELSE/OP_ENDIF are handled by evaluate
+    itself and are not counted.'''
+
+    active = None
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.reset()
+        # OP_CODE_DISPATCH with every operation wrapped in a timer
+        self.dispatch = {
+            cmd: (convention, self.timed_operation(cmd, convention, operation))
+            for cmd, (convention, operation) in OP_CODE_DISPATCH.items()}
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def enable(self):
+        ScriptProfiler.active = self
+        return self
+
+    @classmethod
+    def disable(cls):
+        profiler = cls.active
+        cls.active = None
+        return profiler
+
+    def reset(self):
+        # name -> [count, seconds]
+        self.ops = {}
+        self.templates = {}
+        self.timers = {}
+
+    def timed_operation(self, cmd, convention, operation):
+        name = OP_CODE_NAMES.get(cmd, 'OP_[{}]'.format(cmd))
+
+        def timed(*args):
+            start = perf_counter()
+            try:
+                return operation(*args)
+            finally:
+                elapsed = perf_counter() - start
+                self.record('op', name, elapsed)
+                if convention == SIGNATURE_OP:
+                    self.record('signature', name, elapsed)
+        return timed
+
+    def record(self, kind, name, elapsed):
+        if kind == 'op':
+            counters, key = self.ops, name
+        elif kind == 'template':
+            counters, key = self.templates, name
+        else:
+            counters, key = self.timers, kind
+        counter = counters.get(key)
+        if counter is None:
+            counter = counters[key] = [0, 0.0]
+        counter[0] += 1
+        counter[1] += elapsed
+        if self.hook is not None:
+            self.hook(kind, name, elapsed)
+
+    def stats(self):
+        return {
+            'ops': {name: tuple(counter) for name, counter in self.ops.items()},
+            'templates': {name: tuple(counter)
+                          for name, counter in self.templates.items()},
+            'timers': {name: tuple(counter) for name, counter in self.timers.items()},
+        }
+
+    def report(self):
+        '''The stats as a text table, slowest first in each section'''
+        lines = []
+        for title, counters in (('timer', self.timers),
+                                ('template', self.templates),
+                                ('opcode', self.ops)):
+            lines.append('{:<28} {:>10} {:>12} {:>10}'.format(
+                title, 'count', 'total ms', 'avg us'))
+            for name, (count, total) in sorted(
+                    counters.items(), key=lambda item: -item[1][1]):
+                lines.append('{:<28} {:>10} {:>12.3f} {:>10.1f}'.format(
+                    name, count, total * 1e3, total / count * 1e6))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def dispatch_table():
+    '''OP_CODE_DISPATCH, or the timed copy of the active ScriptProfiler'''
+    profiler = ScriptProfiler.active
+    if profiler is None:
+        return OP_CODE_DISPATCH
+    return profiler.dispatch
+
+
+def script_kind(script_pubkey):
+    '''The template of script_pubkey, as the profiler reports it'''
+    return script_template(script_pubkey.raw_serialize()) or 'nonstandard'
 
 
 class Script:
+    # bumped whenever cmds is replaced, see Tx._cache
+    generation = 0
 
     def __init__(self, cmds=None):
+        self._raw = None
         if cmds is None:
-            self.cmds = []
+            self._cmds = []
         else:
-            self.cmds = cmds
+            self._cmds = cmds
 
     def __repr__(self):
         result = []
@@ -75,128 +361,174 @@ class Script:
     def parse(cls, s):
         # get the length of the entire field
         length = read_varint(s)
-        # initialize the cmds array
-        cmds = []
-        # initialize the number of bytes we've read to 0
-        count = 0
-        # loop until we've read length bytes
-        while count < length:
-            # get the current byte
-            current = s.read(1)
-            # increment the bytes we've read
-            count += 1
-            # convert the current byte to an integer
-            current_byte = current[0]
-            # if the current byte is between 1 and 75 inclusive
-            if current_byte >= 1 and current_byte <= 75:
-                # we have an cmd set n to be the current byte
-                n = current_byte
-                # add the next n bytes as an cmd
-                cmds.append(s.read(n))
-                # increase the count by n
-                count += n
-            elif current_byte == 76:
-                # op_pushdata1
-                data_length = little_endian_to_int(s.read(1))
-                cmds.append(s.read(data_length))
-                count += data_length + 1
-            elif current_byte == 77:
-                # op_pushdata2
-                data_length = little_endian_to_int(s.read(2))
-                cmds.append(s.read(data_length))
-                count += data_length + 2
-            else:
-                # we have an opcode. set the current byte to op_code
-                op_code = current_byte
-                # add the op_code to the list of cmds
-                cmds.append(op_code)
-        if count != length:
+        raw = s.read(length)
+        if len(raw) != length:
             raise SyntaxError('parsing script failed')
-        return cls(cmds)
+        # a script read on its own is decoded right away, from_raw scripts
+        # are decoded the first time cmds is read
+        script = cls.__new__(cls)
+        script._cmds = decode_cmds(raw)
+        script._raw = raw
+        return script
+
+    @classmethod
+    def parse_at(cls, buf, offset):
+        '''Same as parse, but reads from a bytes-like buffer starting at
+        offset and returns (script, offset after the script).'''
+        length = buf[offset]
+        if length < 0xfd:
+            offset += 1
+        else:
+            length, offset = read_varint_at(buf, offset)
+        end = offset + length
+        if end > len(buf):
+            raise SyntaxError('parsing script failed')
+        return cls.from_raw(bytes(buf[offset:end])), end
+
+    @classmethod
+    def from_raw(cls, raw):
+        '''A script backed by its raw serialization (without the length
+        prefix). raw_serialize returns raw as is until cmds is replaced or
+        invalidate() is called.'''
+        script = cls.__new__(cls)
+        script._cmds = None
+        script._raw = raw
+        return script
+
+    @property
+    def cmds(self):
+        if self._cmds is None:
+            self._cmds = decode_cmds(self._raw)
+        return self._cmds
+
+    @cmds.setter
+    def cmds(self, cmds):
+        self._cmds = cmds
+        self._raw = None
+        Script.generation += 1
+
+    def invalidate(self):
+        '''Stops using the raw bytes this script was parsed from. Call it
+        after changing cmds in place.'''
+        if self._cmds is not None:
+            self._raw = None
 
     def raw_serialize(self):
-        # initialize what we'll send back
-        result = b''
+        raw = self._raw
+        if raw is not None:
+            return raw
+        buf = bytearray()
+        self.raw_serialize_into(buf)
+        return bytes(buf)
+
+    def raw_serialize_into(self, buf):
+        '''Appends the raw serialization (no prepended length) to the
+        bytearray buf'''
+        raw = self._raw
+        if raw is not None:
+            buf += raw
+            return
+        append = buf.append
         # go through each cmd
         for cmd in self.cmds:
             # if the cmd is an integer, it's an opcode
             if type(cmd) == int:
-                # turn the cmd into a single byte integer using int_to_little_endian
-                result += int_to_little_endian(cmd, 1)
+                append(cmd)
             else:
                 # otherwise, this is an element
                 # get the length in bytes
                 length = len(cmd)
                 # for large lengths, we have to use a pushdata opcode
-                if length < 75:
-                    # turn the length into a single byte integer
-                    result += int_to_little_endian(length, 1)
-                elif length > 75 and length < 0x100:
+                if length <= 75:
+                    # the length itself is the push opcode
+                    append(length)
+                elif length < 0x100:
                     # 76 is pushdata1
-                    result += int_to_little_endian(76, 1)
-                    result += int_to_little_endian(length, 1)
-                elif length >= 0x100 and length <= 520:
+                    append(76)
+                    append(length)
+                elif length <= 520:
                     # 77 is pushdata2
-                    result += int_to_little_endian(77, 1)
-                    result += int_to_little_endian(length, 2)
+                    append(77)
+                    buf += int_to_little_endian(length, 2)
                 else:
                     raise ValueError('too long an cmd')
-                result += cmd
-        return result
+                buf += cmd
 
     def serialize(self):
         # get the raw serialization (no prepended length)
         result = self.raw_serialize()
-        # get the length of the whole thing
-        total = len(result)
         # encode_varint the total length of the result and prepend
-        return encode_varint(total) + result
+        return encode_varint(len(result)) + result
 
-    def evaluate(self, z, witness):
+    def serialize_into(self, buf):
+        '''Appends the varint length and the raw serialization to the
+        bytearray buf'''
+        raw = self._raw
+        if raw is not None:
+            buf += encode_varint(len(raw))
+            buf += raw
+            return
+        # hold a byte for the length, which is only known afterwards
+        start = len(buf)
+        buf.append(0)
+        self.raw_serialize_into(buf)
+        length = len(buf) - start - 1
+        if length < 0xfd:
+            buf[start] = length
+        else:
+            buf[start:start + 1] = encode_varint(length)
+
+    def evaluate(self, z, witness, batch=None):
+        # when batch is a list, signature checks are assumed to pass and
+        # appended to it as (point, z, signature) for verify_batch
         # create a copy as we may need to add to this list if we have a
         # RedeemScript
         cmds = self.cmds[:]
         stack = []
         altstack = []
-        while len(cmds) > 0:
-            cmd = cmds.pop(0)
+        # cmds[pc] is the next command; OP_IF/OP_NOTIF jump with branches
+        # and the OP_ELSE/OP_ENDIF of an executed branch with markers
+        pc = 0
+        branches, markers = branch_map(cmds)
+        dispatch = dispatch_table()
+        while pc < len(cmds):
+            cmd = cmds[pc]
+            pc += 1
             if type(cmd) == int:
-                # do what the opcode says
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):
-                    # op_if/op_notif require the cmds array
-                    if not operation(stack, cmds):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (107, 108):
-                    # op_toaltstack/op_fromaltstack require the altstack
-                    if not operation(stack, altstack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (172, 173, 174, 175):
+                if (cmd == 103 or cmd == 104) and pc - 1 in markers:
+                    pc = markers[pc - 1][1]
+                    continue
+                convention, operation = dispatch[cmd]
+                if convention == PLAIN_OP:
+                    ok = operation(stack)
+                elif convention == SIGNATURE_OP:
                     # these are signing operations, they need a sig_hash
                     # to check against
-                    if not operation(stack, z):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    ok = operation(stack, z, batch)
+                elif convention == ALTSTACK_OP:
+                    ok = operation(stack, altstack)
                 else:
-                    if not operation(stack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    # op_if/op_notif, a missing OP_ENDIF fails like it does
+                    # in op_if
+                    ok = len(stack) > 0 and pc - 1 in branches
+                    if ok and (decode_num(stack.pop()) == 0) == (cmd == 99):
+                        pc = branches[pc - 1]
+                if not ok:
+                    LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                    return False
             else:
                 # add the cmd to the stack
                 stack.append(cmd)
                 # p2sh rule. if the next three cmds are:
                 # OP_HASH160 <20 byte hash> OP_EQUAL this is the RedeemScript
                 # OP_HASH160 == 0xa9 and OP_EQUAL == 0x87
-                if len(cmds) == 3 and cmds[0] == 0xa9 \
-                    and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
-                    and cmds[2] == 0x87:
-                    redeem_script = encode_varint(len(cmd)) + cmd
+                rest = remaining_cmds(cmds, pc, markers, 4)
+                if len(rest) == 3 and rest[0] == 0xa9 \
+                    and type(rest[1]) == bytes and len(rest[1]) == 20 \
+                    and rest[2] == 0x87:
                     # we execute the next three opcodes
-                    cmds.pop()
-                    h160 = cmds.pop()
-                    cmds.pop()
+                    pc = len(cmds)
+                    h160 = rest[1]
                     if not op_hash160(stack):
                         return False
                     stack.append(h160)
@@ -207,9 +539,8 @@ class Script:
                         LOGGER.info('bad p2sh h160')
                         return False
                     # hashes match! now add the RedeemScript
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    stream = BytesIO(redeem_script)
-                    cmds.extend(Script.parse(stream).cmds)
+                    cmds.extend(decode_script(cmd))
+                    branches, markers = extend_branch_map(cmds, pc, branches, markers)
                 # witness program version 0 rule. if stack cmds are:
                 # 0 <20 byte hash> this is p2wpkh
                 # tag::source3[]
@@ -218,6 +549,7 @@ class Script:
                     stack.pop()
                     cmds.extend(witness)
                     cmds.extend(p2pkh_script(h160).cmds)
+                    branches, markers = extend_branch_map(cmds, pc, branches, markers)
                 # end::source3[]
                 # witness program version 0 rule. if stack cmds are:
                 # 0 <32 byte hash> this is p2wsh
@@ -231,10 +563,9 @@ class Script:
                         print('bad sha256 {} vs {}'.format
                             (s256.hex(), sha256(witness_script).hex()))
                         return False
-                    stream = BytesIO(encode_varint(len(witness_script)) 
-                        + witness_script)
-                    witness_script_cmds = Script.parse(stream).cmds  # <6>
+                    witness_script_cmds = decode_script(witness_script)  # <6>
                     cmds.extend(witness_script_cmds)
+                    branches, markers = extend_branch_map(cmds, pc, branches, markers)
                 # end::source6[]
         if len(stack) == 0:
             return False
@@ -248,6 +579,9 @@ class Script:
         # there should be exactly 5 cmds
         # OP_DUP (0x76), OP_HASH160 (0xa9), 20-byte hash, OP_EQUALVERIFY (0x88),
         # OP_CHECKSIG (0xac)
+        raw = self._raw
+        if raw is not None:
+            return script_template(raw) == 'p2pkh'
         return len(self.cmds) == 5 and self.cmds[0] == 0x76 \
             and self.cmds[1] == 0xa9 \
             and type(self.cmds[2]) == bytes and len(self.cmds[2]) == 20 \
@@ -258,18 +592,27 @@ class Script:
         OP_HASH160 <20 byte hash> OP_EQUAL pattern.'''
         # there should be exactly 3 cmds
         # OP_HASH160 (0xa9), 20-byte hash, OP_EQUAL (0x87)
+        raw = self._raw
+        if raw is not None:
+            return script_template(raw) == 'p2sh'
         return len(self.cmds) == 3 and self.cmds[0] == 0xa9 \
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20 \
             and self.cmds[2] == 0x87
 
     # tag::source2[]
     def is_p2wpkh_script_pubkey(self):  # <2>
+        raw = self._raw
+        if raw is not None:
+            return script_template(raw) == 'p2wpkh'
         return len(self.cmds) == 2 and self.cmds[0] == 0x00 \
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20
     # end::source2[]
 
     # tag::source5[]
     def is_p2wsh_script_pubkey(self):
+        raw = self._raw
+        if raw is not None:
+            return script_template(raw) == 'p2wsh'
         return len(self.cmds) == 2 and self.cmds[0] == 0x00 \
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 32
     # end::source5[]
@@ -289,3 +632,86 @@ class Script:
         raise ValueError('Unknown ScriptPubKey')
 
 
+def evaluate_template(script_sig, script_pubkey, z, witness, batch=None):
+    '''Verifies P2PKH, P2WPKH, P2SH-P2WPKH and P2WSH multisig spends
+    without the interpreter, with the same result as evaluating
+    script_sig + script_pubkey. Returns None for anything else.'''
+    if script_pubkey.is_p2pkh_script_pubkey():
+        return evaluate_p2pkh(script_sig.cmds, script_pubkey.cmds[2], z, batch)
+    if script_pubkey.is_p2wpkh_script_pubkey():
+        if script_sig.cmds:
+            return None
+        return evaluate_p2pkh(witness, script_pubkey.cmds[1], z, batch)
+    if script_pubkey.is_p2sh_script_pubkey():
+        cmds = script_sig.cmds
+        if len(cmds) != 1 or type(cmds[0]) != bytes:
+            return None
+        redeem_script = cmds[0]
+        # OP_0 <20 byte hash>
+        if len(redeem_script) != 22 or redeem_script[:2] != b'\x00\x14':
+            return None
+        if hash160(redeem_script) != script_pubkey.cmds[1]:
+            return False
+        return evaluate_p2pkh(witness, redeem_script[2:], z, batch)
+    if script_pubkey.is_p2wsh_script_pubkey():
+        if script_sig.cmds or not witness or type(witness[-1]) != bytes:
+            return None
+        witness_script = witness[-1]
+        if sha256(witness_script) != script_pubkey.cmds[1]:
+            return None
+        return evaluate_multisig(witness[:-1], witness_script, z, batch)
+    return None
+
+
+def evaluate_p2pkh(cmds, h160, z, batch=None):
+    '''<signature> <sec> followed by p2pkh_script(h160)'''
+    if cmds is None or len(cmds) != 2:
+        return None
+    sig, sec = cmds
+    # an empty signature would trigger the witness program rule
+    if type(sig) != bytes or type(sec) != bytes or sig == b'':
+        return None
+    if hash160(sec) != h160:
+        return False
+    stack = [sig, sec]
+    checksig = dispatch_table()[0xac][1]
+    if not checksig(stack, z, batch):
+        return False
+    return stack[-1] != b''
+
+
+def evaluate_multisig(items, witness_script, z, batch=None):
+    '''The witness items followed by an m-of-n OP_CHECKMULTISIG script'''
+    try:
+        cmds = decode_script(witness_script)
+    except SyntaxError:
+        return None
+    if len(cmds) < 3 or cmds[-1] != 0xae \
+            or type(cmds[0]) != int or not 81 <= cmds[0] <= 96 \
+            or type(cmds[-2]) != int or not 81 <= cmds[-2] <= 96:
+        return None
+    sec_pubkeys = cmds[1:-2]
+    if any(type(sec) != bytes for sec in sec_pubkeys):
+        return None
+    stack = []
+    for item in items:
+        if item == 0:
+            # OP_0
+            stack.append(b'')
+        elif type(item) == bytes:
+            stack.append(item)
+        else:
+            return None
+    # these pushes would trigger the witness program rules
+    if len(items) >= 2 and type(items[1]) == bytes \
+            and stack[0] == b'' and len(stack[1]) in (20, 32):
+        return None
+    stack.append(encode_num(cmds[0] - 80))
+    stack.extend(sec_pubkeys)
+    stack.append(encode_num(cmds[-2] - 80))
+    checkmultisig = dispatch_table()[0xae][1]
+    if not checkmultisig(stack, z, batch):
+        return False
+    return len(stack) > 0 and stack[-1] != b''
+
+
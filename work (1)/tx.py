@@ -1,18 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from io import BytesIO
+from threading import Lock
+from time import perf_counter
+from weakref import WeakKeyDictionary
 
+import asyncio
 import json
 import requests
+import sqlite3
+import struct
 
-from ecc import PrivateKey
+from ecc import PrivateKey, verify_batch
 from helper import (
     encode_varint,
     hash256,
-    int_to_little_endian,
     little_endian_to_int,
     read_varint,
+    LRUCache,
+    read_varint_at,
     SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_NONE,
+    SIGHASH_SINGLE,
+)
+from op import SIG_CACHE
+from script import (
+    evaluate_template,
+    p2pkh_script,
+    Script,
+    script_kind,
+    ScriptProfiler,
 )
-from script import p2pkh_script, Script
 
 from dotenv import load_dotenv
 
@@ -20,70 +39,272 @@ load_dotenv()
 
 import os
 
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+
+class TxStore:
+    '''Raw transactions kept in a SQLite database keyed by txid. Entries
+    are written as they are fetched and read back one at a time.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS txs '
+                '(id TEXT PRIMARY KEY, raw BLOB NOT NULL) WITHOUT ROWID')
+
+    def __repr__(self):
+        return 'TxStore({})'.format(self.filename)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM txs').fetchone()[0]
+
+    def __contains__(self, tx_id):
+        return self.get(tx_id) is not None
+
+    def get(self, tx_id):
+        '''Returns the raw transaction or None'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT raw FROM txs WHERE id = ?', (tx_id,)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def put(self, tx_id, raw):
+        self.put_many([(tx_id, raw)])
+
+    def put_many(self, items):
+        '''Stores (tx_id, raw) pairs in one transaction'''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO txs (id, raw) VALUES (?, ?)',
+                ((tx_id, bytes(raw)) for tx_id, raw in items))
+
+    def import_json(self, filename):
+        '''Copies a cache written by TxFetcher.dump_cache into the store'''
+        with open(filename, 'r') as f:
+            disk_cache = json.load(f)
+        self.put_many((k, bytes.fromhex(raw_hex)) for k, raw_hex in disk_cache.items())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def estimated_tx_size(value):
+    '''Rough memory footprint of a TxFetcher cache entry, which is either
+    raw bytes or a parsed Tx (python objects take several times the size
+    of the serialization)'''
+    if isinstance(value, bytes):
+        return len(value)
+    return 4 * len(value.serialize())
+
+
 class TxFetcher:
-    cache = {}
+    cache = LRUCache(max_size=10000, sizeof=estimated_tx_size)
+    # keep raw bytes in the cache and parse a LazyTx on every fetch
+    cache_raw = False
+    # set to a filename to keep every fetched transaction in a TxStore
+    store_file = None
+    store = None
+    store_lock = Lock()
+    # set to e.g. 'http://localhost:8080' to use another endpoint
+    base_url = None
+    max_workers = 8
+    timeout = 30
+    session = None
+    session_lock = Lock()
     
     @classmethod
     def get_url(cls, testnet=False):
+        if cls.base_url:
+            return cls.base_url
         if testnet:
             return f"https://go.getblock.io/{os.getenv('TESTNET_ACCESS_TOKEN')}"
         else:
             return f"https://go.getblock.io/{os.getenv('MAINNET_ACCESS_TOKEN')}"
 
+    @classmethod
+    def get_session(cls):
+        '''A requests.Session shared by all fetches so connections to the
+        endpoint are kept alive and pooled'''
+        with cls.session_lock:
+            if cls.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=2, pool_maxsize=cls.max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls.session = session
+        return cls.session
+
+    @classmethod
+    def get_store(cls):
+        '''The TxStore for store_file, opened once and shared by all
+        fetches'''
+        with cls.store_lock:
+            if cls.store is None and cls.store_file:
+                cls.store = TxStore(cls.store_file)
+        return cls.store
+
+    @classmethod
+    def configure_cache(cls, max_size=10000, max_bytes=None, raw=False):
+        '''Replaces the in-memory cache with one bounded by entry count
+        and/or estimated bytes. With raw, only the serialized transactions
+        are kept.'''
+        cls.cache = LRUCache(max_size=max_size, max_bytes=max_bytes,
+                             sizeof=estimated_tx_size)
+        cls.cache_raw = raw
+
+    @classmethod
+    def cache_stats(cls):
+        return cls.cache.stats()
+
     @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
-        if fresh or (tx_id not in cls.cache):
-            url = f"{cls.get_url(testnet)}/rest/tx/{tx_id}.hex"
-            response = requests.get(url)
+        tx = None if fresh else cls.cache.get(tx_id)
+        if isinstance(tx, bytes):
+            tx, _ = LazyTx.parse_at(tx, testnet=testnet)
+        elif tx is None:
+            store = cls.get_store()
+            raw = None
+            if store is not None and not fresh:
+                raw = store.get(tx_id)
+            if raw is not None:
+                tx = cls.parse_raw(raw, testnet)
+            else:
+                url = f"{cls.get_url(testnet)}/rest/tx/{tx_id}.hex"
+                response = cls.get_session().get(url, timeout=cls.timeout)
+
+
 
+                try:
+                    raw = bytes.fromhex(response.text.strip())
+                except ValueError:
+                    raise ValueError(f"Unexpected Response: {response.text}")
+                tx = cls.parse_raw(raw, testnet)
+                if tx.id() != tx_id:
+                    raise ValueError(f"Not Same Id: {tx.id()} != {tx_id}")
+                if store is not None:
+                    store.put(tx_id, raw)
 
+            cls.cache[tx_id] = raw if cls.cache_raw else tx
+        tx.testnet = testnet
+        return tx
 
-            try:
-                raw = bytes.fromhex(response.text.strip())
-            except ValueError:
-                raise ValueError(f"Unexpected Response: {response.text}")
-            if raw[4] == 0:
-                raw = raw[:4] + raw[6:]
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-                tx.locktime = little_endian_to_int(raw[-4:])
+    @classmethod
+    def fetch_many(cls, tx_ids, testnet=False, fresh=False, max_workers=None):
+        '''Fetches several transactions, downloading the ones that are not
+        cached concurrently with up to max_workers threads. Returns them
+        in the order of tx_ids.'''
+        tx_ids = list(tx_ids)
+        result = {}
+        missing = {}
+        for tx_id in tx_ids:
+            if tx_id in result or tx_id in missing:
+                continue
+            if not fresh and tx_id in cls.cache:
+                result[tx_id] = cls.fetch(tx_id, testnet=testnet)
             else:
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-            if tx.id() != tx_id:
-                raise ValueError(f"Not Same Id: {tx.id()} != {tx_id}")
+                missing[tx_id] = None
+        missing = list(missing)
+        if len(missing) == 1:
+            result[missing[0]] = cls.fetch(missing[0], testnet=testnet, fresh=fresh)
+        elif missing:
+            workers = min(max_workers or cls.max_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                txs = executor.map(
+                    lambda tx_id: cls.fetch(tx_id, testnet=testnet, fresh=fresh),
+                    missing)
+                result.update(zip(missing, txs))
+        return [result[tx_id] for tx_id in tx_ids]
 
-            cls.cache[tx_id] = tx
-        cls.cache[tx_id].testnet = testnet
-        return cls.cache[tx_id]
+    @classmethod
+    def parse_raw(cls, raw, testnet=False):
+        if raw[4] == 0:
+            raw = raw[:4] + raw[6:]
+            tx, _ = Tx.parse_at(raw, testnet=testnet)
+            tx.locktime = little_endian_to_int(raw[-4:])
+        else:
+            tx, _ = Tx.parse_at(raw, testnet=testnet)
+        return tx
 
     @classmethod
     def load_cache(cls, filename):
         disk_cache = json.loads(open(filename, 'r').read())
         for k, raw_hex in disk_cache.items():
-            cls.cache[k] = Tx.parse(BytesIO(bytes.fromhex(raw_hex)))
+            raw = bytes.fromhex(raw_hex)
+            cls.cache[k] = raw if cls.cache_raw else Tx.parse(BytesIO(raw))
 
     @classmethod
     def dump_cache(cls, filename):
         with open(filename, 'w') as f:
-            to_dump = {k: tx.serialize().hex() for k, tx in cls.cache.items()}
+            to_dump = {k: (tx if isinstance(tx, bytes) else tx.serialize()).hex()
+                       for k, tx in cls.cache.items()}
             s = json.dumps(to_dump, sort_keys=True, indent=4)
             f.write(s)
 
 
 
+class AsyncTxFetcher:
+    '''asyncio front end to TxFetcher. Transactions go through the same
+    cache and store; downloads run in worker threads, at most
+    max_concurrency at a time, and concurrent requests for the same txid
+    share one download.'''
+    max_concurrency = 8
+    # per event loop: (semaphore, {(tx_id, testnet): task})
+    loop_state = WeakKeyDictionary()
+
+    @classmethod
+    def get_loop_state(cls):
+        loop = asyncio.get_running_loop()
+        if loop not in cls.loop_state:
+            cls.loop_state[loop] = (asyncio.Semaphore(cls.max_concurrency), {})
+        return cls.loop_state[loop]
+
+    @classmethod
+    async def fetch(cls, tx_id, testnet=False, fresh=False):
+        if not fresh and tx_id in TxFetcher.cache:
+            return TxFetcher.fetch(tx_id, testnet=testnet)
+        semaphore, in_flight = cls.get_loop_state()
+        key = (tx_id, testnet)
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(cls.download(semaphore, tx_id, testnet, fresh))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+        # a cancelled caller must not cancel the download others wait for
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def download(cls, semaphore, tx_id, testnet, fresh):
+        async with semaphore:
+            return await asyncio.to_thread(TxFetcher.fetch, tx_id, testnet, fresh)
+
+    @classmethod
+    async def fetch_many(cls, tx_ids, testnet=False, fresh=False):
+        return await asyncio.gather(
+            *[cls.fetch(tx_id, testnet=testnet, fresh=fresh) for tx_id in tx_ids])
+
+
 class Tx:
     command = b'tx'
 
     def __init__(self, version, tx_ins, tx_outs, 
         locktime, testnet=False, segwit=False):
+        self._cached = {}
+        self._cached_stamp = None
         self.version = version
         self.tx_ins = tx_ins
         self.tx_outs = tx_outs
         self.locktime = locktime
         self.testnet = testnet
         self.segwit = segwit
-        self._hash_prevouts = None
-        self._hash_sequence = None
-        self._hash_outputs = None
 
 
     def __repr__(self):
@@ -101,14 +322,81 @@ class Tx:
             self.locktime,
         )
 
+    @property
+    def tx_ins(self):
+        return self._tx_ins
+
+    @tx_ins.setter
+    def tx_ins(self, tx_ins):
+        self._tx_ins = tx_ins
+        self._changed()
+
+    @property
+    def tx_outs(self):
+        return self._tx_outs
+
+    @tx_outs.setter
+    def tx_outs(self, tx_outs):
+        self._tx_outs = tx_outs
+        self._changed()
+
+    def outpoints(self):
+        '''Returns (prev_tx, prev_index) for every input'''
+        return [(tx_in.prev_tx, tx_in.prev_index) for tx_in in self.tx_ins]
+
+    def _cache(self):
+        '''Memoized serializations and hashes. They are dropped when
+        version, locktime or segwit changes, when tx_ins or tx_outs is
+        replaced, when any Script's cmds is replaced and by invalidate().'''
+        stamp = (self.version, self.locktime, self.segwit, Script.generation)
+        if stamp != self._cached_stamp:
+            self._cached = {}
+            self._cached_stamp = stamp
+        return self._cached
+
+    def _changed(self):
+        self._cached_stamp = None
+
+    def invalidate(self):
+        '''Call after changing an input, output, witness or script of this
+        transaction in place, e.g. tx.tx_ins[0].sequence -= 1,
+        tx.tx_ins[0].script_sig = script_sig or
+        script_pubkey.cmds[2] = h160. Replacing tx_ins, tx_outs or a
+        script's cmds, and signing, need no call.'''
+        for tx_in in self._tx_ins or ():
+            tx_in.script_sig.invalidate()
+        for tx_out in self._tx_outs or ():
+            tx_out.script_pubkey.invalidate()
+        self._changed()
+
     def id(self):
         return self.hash().hex()
 
     def hash(self):
-        return hash256(self.serialize_legacy())[::-1]
+        cache = self._cache()
+        if 'hash' not in cache:
+            cache['hash'] = hash256(self.serialize_legacy())[::-1]
+        return cache['hash']
+
+    def wtxid(self):
+        return self.witness_hash().hex()
+
+    def witness_hash(self):
+        '''Hash of the serialization including witnesses, same as hash()
+        for a legacy transaction'''
+        cache = self._cache()
+        if 'witness_hash' not in cache:
+            cache['witness_hash'] = hash256(self.serialize())[::-1]
+        return cache['witness_hash']
    
     @classmethod
     def parse(cls, s, testnet=False):
+        if isinstance(s, BytesIO):
+            # parse straight out of the stream's bytes, getvalue only
+            # copies them the first time after a write
+            tx, end = cls.parse_at(s.getvalue(), s.tell(), testnet=testnet)
+            s.seek(end)
+            return tx
         s.read(4)  # <1>
         if s.read(1) == b'\x00':  # <2>
             parse_method = cls.parse_segwit
@@ -160,6 +448,102 @@ class Tx:
         return cls(version, inputs, outputs, locktime, 
                    testnet=testnet, segwit=True)
     
+    @classmethod
+    def parse_at(cls, buf, offset=0, testnet=False):
+        '''Parses a transaction from a bytes-like buffer (bytes, bytearray
+        or memoryview) starting at offset. Returns (tx, offset after the
+        transaction), so a block's transactions can be read back to back.'''
+        version, = UINT32.unpack_from(buf, offset)
+        offset += 4
+        segwit = buf[offset] == 0
+        if segwit:
+            if buf[offset + 1] != 1:
+                raise RuntimeError('Not a segwit transaction {}'.format(
+                    bytes(buf[offset:offset + 2])))
+            offset += 2
+        # everything is read inline and TxIn, TxOut and Script objects are
+        # filled in directly: per-field function calls cost more than the
+        # parsing itself
+        unpack_uint32 = UINT32.unpack_from
+        unpack_uint64 = UINT64.unpack_from
+        new = object.__new__
+        size = len(buf)
+        num_inputs = buf[offset]
+        if num_inputs < 0xfd:
+            offset += 1
+        else:
+            num_inputs, offset = read_varint_at(buf, offset)
+        inputs = []
+        append = inputs.append
+        for _ in range(num_inputs):
+            length = buf[offset + 36]
+            if length < 0xfd:
+                start = offset + 37
+            else:
+                length, start = read_varint_at(buf, offset + 36)
+            end = start + length
+            if end > size:
+                raise SyntaxError('parsing script failed')
+            script_sig = new(Script)
+            script_sig._cmds = None
+            script_sig._raw = bytes(buf[start:end])
+            tx_in = new(TxIn)
+            tx_in.prev_tx = bytes(buf[offset:offset + 32])[::-1]
+            tx_in.prev_index, = unpack_uint32(buf, offset + 32)
+            tx_in.script_sig = script_sig
+            tx_in.sequence, = unpack_uint32(buf, end)
+            append(tx_in)
+            offset = end + 4
+        num_outputs = buf[offset]
+        if num_outputs < 0xfd:
+            offset += 1
+        else:
+            num_outputs, offset = read_varint_at(buf, offset)
+        outputs = []
+        append = outputs.append
+        for _ in range(num_outputs):
+            length = buf[offset + 8]
+            if length < 0xfd:
+                start = offset + 9
+            else:
+                length, start = read_varint_at(buf, offset + 8)
+            end = start + length
+            if end > size:
+                raise SyntaxError('parsing script failed')
+            script_pubkey = new(Script)
+            script_pubkey._cmds = None
+            script_pubkey._raw = bytes(buf[start:end])
+            tx_out = new(TxOut)
+            tx_out.amount, = unpack_uint64(buf, offset)
+            tx_out.script_pubkey = script_pubkey
+            append(tx_out)
+            offset = end
+        if segwit:
+            for tx_in in inputs:
+                num_items = buf[offset]
+                if num_items < 0xfd:
+                    offset += 1
+                else:
+                    num_items, offset = read_varint_at(buf, offset)
+                items = []
+                for _ in range(num_items):
+                    item_len = buf[offset]
+                    if item_len < 0xfd:
+                        offset += 1
+                    else:
+                        item_len, offset = read_varint_at(buf, offset)
+                    if item_len == 0:
+                        items.append(0)
+                    else:
+                        end = offset + item_len
+                        items.append(bytes(buf[offset:end]))
+                        offset = end
+                tx_in.witness = items
+        locktime, = UINT32.unpack_from(buf, offset)
+        offset += 4
+        return cls(version, inputs, outputs, locktime,
+                   testnet=testnet, segwit=segwit), offset
+
     def serialize(self):
         if self.segwit:
             return self.serialize_segwit()
@@ -167,195 +551,334 @@ class Tx:
             return self.serialize_legacy()
 
     def serialize_legacy(self):  # <1>
-        result = int_to_little_endian(self.version, 4)
-        result += encode_varint(len(self.tx_ins))
-        for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
-        for tx_out in self.tx_outs:
-            result += tx_out.serialize()
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+        cache = self._cache()
+        if 'legacy' not in cache:
+            cache['legacy'] = self._serialize(False)
+        return cache['legacy']
 
     def serialize_segwit(self):
-        result = int_to_little_endian(self.version, 4)
-        result += b'\x00\x01'  # <2>
-        result += encode_varint(len(self.tx_ins))
+        cache = self._cache()
+        if 'segwit' not in cache:
+            cache['segwit'] = self._serialize(True)
+        return cache['segwit']
+
+    def serialize_into(self, buf):
+        '''Appends serialize() to the bytearray buf, writing the inputs and
+        outputs straight into it unless the serialization is cached'''
+        key = 'segwit' if self.segwit else 'legacy'
+        cache = self._cache()
+        if key in cache:
+            buf += cache[key]
+        else:
+            self._serialize_into(buf, self.segwit)
+
+    def _serialize(self, segwit):
+        buf = bytearray()
+        self._serialize_into(buf, segwit)
+        return bytes(buf)
+
+    def _serialize_into(self, buf, segwit):
+        buf += UINT32.pack(self.version)
+        if segwit:
+            buf += b'\x00\x01'  # <2>
+        buf += encode_varint(len(self.tx_ins))
         for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
+            tx_in.serialize_into(buf)
+        buf += encode_varint(len(self.tx_outs))
         for tx_out in self.tx_outs:
-            result += tx_out.serialize()
-        for tx_in in self.tx_ins:  # <3>
-            result += int_to_little_endian(len(tx_in.witness), 1)
-            for item in tx_in.witness:
-                if type(item) == int:
-                    result += int_to_little_endian(item, 1)
-                else:
-                    result += encode_varint(len(item)) + item
-        result += int_to_little_endian(self.locktime, 4)
-        return result
-
-    def fee(self):
-        
+            tx_out.serialize_into(buf)
+        if segwit:
+            for tx_in in self.tx_ins:  # <3>
+                buf.append(len(tx_in.witness))
+                for item in tx_in.witness:
+                    if type(item) == int:
+                        buf.append(item)
+                    else:
+                        buf += encode_varint(len(item))
+                        buf += item
+        buf += UINT32.pack(self.locktime)
+
+    def resolve_prevouts(self):
+        '''Maps the outpoint of every input to the TxOut it spends,
+        fetching all previous transactions at once'''
+        return resolve_prevouts([self], testnet=self.testnet)
+
+    async def prefetch_async(self):
+        if not self.is_coinbase():
+            await AsyncTxFetcher.fetch_many(
+                [tx_in.prev_tx.hex() for tx_in in self.tx_ins], testnet=self.testnet)
+
+    async def fee_async(self):
+        await self.prefetch_async()
+        return self.fee()
+
+    async def verify_async(self, batch=False):
+        '''verify() after fetching every previous transaction concurrently
+        without blocking the event loop'''
+        await self.prefetch_async()
+        return self.verify(batch=batch)
+
+    def fee(self, prevouts=None):
+        if prevouts is None:
+            prevouts = self.resolve_prevouts()
         input_sum, output_sum = 0, 0
         for tx_in in self.tx_ins:
-            input_sum += tx_in.value(self.testnet)
+            input_sum += tx_in.value(self.testnet, prevouts)
         for tx_out in self.tx_outs:
             output_sum += tx_out.amount
         return input_sum - output_sum
 
-    def sig_hash(self, input_index, redeem_script=None):
-        
-        s = int_to_little_endian(self.version, 4)
-        s += encode_varint(len(self.tx_ins))
-        for i, tx_in in enumerate(self.tx_ins):
-            if i == input_index:
-                if redeem_script:
-                    script_sig = redeem_script
-                else:
-                    script_sig = tx_in.script_pubkey(self.testnet)
-            else:
-                script_sig = None
-
-            s += TxIn(
-                prev_tx=tx_in.prev_tx,
-                prev_index=tx_in.prev_index,
-                script_sig=script_sig,
-                sequence=tx_in.sequence,
-            ).serialize()
-
-        s += encode_varint(len(self.tx_outs))
-
-        for tx_out in self.tx_outs:
-            s += tx_out.serialize()
-
-        s += int_to_little_endian(self.locktime, 4)
-
-        s += int_to_little_endian(SIGHASH_ALL, 4)
-
-        h256 = hash256(s)
-
-        return int.from_bytes(h256, 'big')
+    def sig_hash(self, input_index, redeem_script=None, hash_type=SIGHASH_ALL, prevouts=None):
+        if redeem_script:
+            script_code = redeem_script
+        else:
+            script_code = self.tx_ins[input_index].script_pubkey(self.testnet, prevouts)
+        cache = self._cache()
+        if 'legacy_sighash' not in cache:
+            cache['legacy_sighash'] = LegacySigHash(self)
+        return cache['legacy_sighash'].sig_hash(
+            input_index, script_code.serialize(), hash_type)
+
+    def _bip143_hashes(self):
+        cache = self._cache()
+        if 'bip143' not in cache:
+            all_prevouts = []
+            all_sequence = []
+            for tx_in in self.tx_ins:
+                all_prevouts.append(tx_in.prev_tx[::-1])
+                all_prevouts.append(UINT32.pack(tx_in.prev_index))
+                all_sequence.append(UINT32.pack(tx_in.sequence))
+            all_outputs = bytearray()
+            for tx_out in self.tx_outs:
+                tx_out.serialize_into(all_outputs)
+            cache['bip143'] = (
+                hash256(b''.join(all_prevouts)),
+                hash256(b''.join(all_sequence)),
+                hash256(all_outputs),
+            )
+        return cache['bip143']
 
     def hash_prevouts(self):
-        if self._hash_prevouts is None:
-            all_prevouts = b''
-            all_sequence = b''
-            for tx_in in self.tx_ins:
-                all_prevouts += tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
-                all_sequence += int_to_little_endian(tx_in.sequence, 4)
-            self._hash_prevouts = hash256(all_prevouts)
-            self._hash_sequence = hash256(all_sequence)
-        return self._hash_prevouts
+        return self._bip143_hashes()[0]
 
     def hash_sequence(self):
-        if self._hash_sequence is None:
-            self.hash_prevouts()  # this should calculate self._hash_prevouts
-        return self._hash_sequence
+        return self._bip143_hashes()[1]
 
     def hash_outputs(self):
-        if self._hash_outputs is None:
-            all_outputs = b''
-            for tx_out in self.tx_outs:
-                all_outputs += tx_out.serialize()
-            self._hash_outputs = hash256(all_outputs)
-        return self._hash_outputs
-
-    def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None):
+        return self._bip143_hashes()[2]
+
+    def _bip143_midstate(self):
+        '''sha256 primed with version, hashPrevouts and hashSequence, the
+        prefix every BIP143 preimage of this transaction starts with, and
+        the constant hashOutputs, locktime and hash type suffix'''
+        cache = self._cache()
+        if 'bip143_midstate' not in cache:
+            hash_prevouts, hash_sequence, hash_outputs = self._bip143_hashes()
+            prefix = sha256(UINT32.pack(self.version))
+            prefix.update(hash_prevouts)
+            prefix.update(hash_sequence)
+            suffix = hash_outputs + UINT32.pack(self.locktime) + UINT32.pack(SIGHASH_ALL)
+            cache['bip143_midstate'] = (prefix, suffix)
+        return cache['bip143_midstate']
+
+    def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None, prevouts=None):
+        return self._sig_hash_bip143(
+            self._bip143_midstate(), input_index, redeem_script, witness_script, prevouts)
+
+    def _sig_hash_bip143(self, midstate, input_index, redeem_script=None,
+                         witness_script=None, prevouts=None):
 
         tx_in = self.tx_ins[input_index]
+        prefix, suffix = midstate
 
-        s = int_to_little_endian(self.version, 4)
-        s += self.hash_prevouts() + self.hash_sequence()
-        s += tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
         if witness_script:
             script_code = witness_script.serialize()
         elif redeem_script:
             script_code = p2pkh_script(redeem_script.cmds[1]).serialize()
         else:
-            script_code = p2pkh_script(tx_in.script_pubkey(self.testnet).cmds[1]).serialize()
-        s += script_code
-        s += int_to_little_endian(tx_in.value(), 8)
-        s += int_to_little_endian(tx_in.sequence, 4)
-        s += self.hash_outputs()
-        s += int_to_little_endian(self.locktime, 4)
-        s += int_to_little_endian(SIGHASH_ALL, 4)
-        return int.from_bytes(hash256(s), 'big')
+            script_pubkey = tx_in.script_pubkey(self.testnet, prevouts)
+            script_code = p2pkh_script(script_pubkey.cmds[1]).serialize()
+        h = prefix.copy()
+        h.update(tx_in.prev_tx[::-1])
+        h.update(UINT32.pack(tx_in.prev_index))
+        h.update(script_code)
+        h.update(UINT64.pack(tx_in.value(self.testnet, prevouts)))
+        h.update(UINT32.pack(tx_in.sequence))
+        h.update(suffix)
+        return int.from_bytes(sha256(h.digest()).digest(), 'big')
+
+    def sig_hashes_bip143(self, input_indexes=None, prevouts=None):
+        '''BIP143 z of every segwit input (all inputs by default), None
+        for legacy inputs. The redeem and witness scripts are taken from
+        each input the same way verify_input does.'''
+        if input_indexes is None:
+            input_indexes = range(len(self.tx_ins))
+        if prevouts is None:
+            prevouts = self.resolve_prevouts()
+        midstate = self._bip143_midstate()
+        result = []
+        for input_index in input_indexes:
+            scripts = self._segwit_scripts(input_index, prevouts)
+            if scripts is None:
+                result.append(None)
+            else:
+                result.append(self._sig_hash_bip143(
+                    midstate, input_index, *scripts, prevouts=prevouts))
+        return result
+
+    def _segwit_scripts(self, input_index, prevouts=None):
+        '''(redeem_script, witness_script) to pass to sig_hash_bip143, or
+        None when the input spends a legacy output'''
+        tx_in = self.tx_ins[input_index]
+        script_pubkey = tx_in.script_pubkey(self.testnet, prevouts)
+        redeem_script = None
+        if script_pubkey.is_p2sh_script_pubkey():
+            cmd = tx_in.script_sig.cmds[-1]
+            redeem_script = Script.from_raw(cmd)
+            script_pubkey = redeem_script
+        if script_pubkey.is_p2wpkh_script_pubkey():
+            return redeem_script, None
+        if script_pubkey.is_p2wsh_script_pubkey():
+            cmd = tx_in.witness[-1]
+            witness_script = Script.from_raw(cmd)
+            return None, witness_script
+        return None
+
+    def verify_input(self, input_index, batch=None, prevouts=None, midstate=None):
+        profiler = ScriptProfiler.active
+        if profiler is not None:
+            return self.profile_input(profiler, input_index, batch, prevouts, midstate)
+        script_sig, script_pubkey, z, witness = self.input_program(
+            input_index, prevouts, midstate)
+        # standard spends are checked directly, the rest is interpreted
+        result = evaluate_template(script_sig, script_pubkey, z, witness, batch)
+        if result is None:
+            combined = script_sig + script_pubkey
+            result = combined.evaluate(z, witness, batch)
+        return result
+
+    def profile_input(self, profiler, input_index, batch=None, prevouts=None,
+                      midstate=None):
+        '''verify_input, recording the time spent on the sighash and on
+        the scripts (by template) in profiler'''
+        start = perf_counter()
+        script_sig, script_pubkey, z, witness = self.input_program(
+            input_index, prevouts, midstate)
+        profiler.record('sighash', 'input_program', perf_counter() - start)
+        kind = script_kind(script_pubkey)
+        start = perf_counter()
+        result = evaluate_template(script_sig, script_pubkey, z, witness, batch)
+        if result is None:
+            kind += ' (interpreted)'
+            combined = script_sig + script_pubkey
+            result = combined.evaluate(z, witness, batch)
+        profiler.record('template', kind, perf_counter() - start)
+        return result
 
-    def verify_input(self, input_index):
+    def input_program(self, input_index, prevouts=None, midstate=None):
+        '''Returns (script_sig, script_pubkey, z, witness) of an input.
+        midstate is _bip143_midstate(), which callers going over many
+        inputs take once and pass in.'''
 
 
         tx_in = self.tx_ins[input_index]
 
-        script_pubkey = tx_in.script_pubkey(testnet=self.testnet)
+        script_pubkey = tx_in.script_pubkey(self.testnet, prevouts)
 
         if script_pubkey.is_p2sh_script_pubkey():
 
             cmd = tx_in.script_sig.cmds[-1]
 
-            raw_redeem = int_to_little_endian(len(cmd), 1) + cmd
-            redeem_script = Script.parse(BytesIO(raw_redeem))
+            redeem_script = Script.from_raw(cmd)
 
             if redeem_script.is_p2wpkh_script_pubkey():
-                z = self.sig_hash_bip143(input_index, redeem_script)
+                z = self._sig_hash_bip143(midstate or self._bip143_midstate(),
+                                          input_index, redeem_script, prevouts=prevouts)
                 witness = tx_in.witness
             elif redeem_script.is_p2wsh_script_pubkey():
                 cmd = tx_in.witness[-1]
-                raw_witness = encode_varint(len(cmd)) + cmd
-                witness_script = Script.parse(BytesIO(raw_witness))
-                z = self.sig_hash_bip143(input_index, witness_script=witness_script)
+                witness_script = Script.from_raw(cmd)
+                z = self._sig_hash_bip143(midstate or self._bip143_midstate(),
+                                          input_index, witness_script=witness_script,
+                                          prevouts=prevouts)
                 witness = tx_in.witness
             else:
-                z = self.sig_hash(input_index, redeem_script)
+                z = self.sig_hash(input_index, redeem_script,
+                                  signature_hash_type(tx_in.script_sig), prevouts)
                 witness = None
         else:
 
             if script_pubkey.is_p2wpkh_script_pubkey():
-                z = self.sig_hash_bip143(input_index)
+                z = self._sig_hash_bip143(midstate or self._bip143_midstate(),
+                                          input_index, prevouts=prevouts)
                 witness = tx_in.witness
             elif script_pubkey.is_p2wsh_script_pubkey():
                 cmd = tx_in.witness[-1]
-                raw_witness = encode_varint(len(cmd)) + cmd
-                witness_script = Script.parse(BytesIO(raw_witness))
-                z = self.sig_hash_bip143(input_index, witness_script=witness_script)
+                witness_script = Script.from_raw(cmd)
+                z = self._sig_hash_bip143(midstate or self._bip143_midstate(),
+                                          input_index, witness_script=witness_script,
+                                          prevouts=prevouts)
                 witness = tx_in.witness
             else:
-                z = self.sig_hash(input_index)
+                z = self.sig_hash(input_index,
+                                  hash_type=signature_hash_type(tx_in.script_sig),
+                                  prevouts=prevouts)
                 witness = None
 
-        combined = tx_in.script_sig + script_pubkey
+        return tx_in.script_sig, script_pubkey, z, witness
 
-        return combined.evaluate(z, witness)
+    def verify(self, batch=False, prevouts=None):
 
-    def verify(self):
 
+        if prevouts is None:
+            prevouts = self.resolve_prevouts()
 
-        if self.fee() < 0:
+        if self.fee(prevouts) < 0:
             return False
 
+        if batch:
+            return verify_inputs_batch(
+                [(self, i) for i in range(len(self.tx_ins))], prevouts)
+
+        midstate = self._bip143_midstate() if self.segwit else None
         for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):
+            if not self.verify_input(i, prevouts=prevouts, midstate=midstate):
                 return False
         return True
 
-    def sign_input(self, input_index, private_key):
+    def sign_input(self, input_index, private_key, hash_type=SIGHASH_ALL):
 
 
-        z = self.sig_hash(input_index)
+        z = self.sig_hash(input_index, hash_type=hash_type)
 
         der = private_key.sign(z).der()
 
-        sig = der + SIGHASH_ALL.to_bytes(1, 'big')
+        sig = der + hash_type.to_bytes(1, 'big')
 
         sec = private_key.point.sec()
 
         script_sig = Script([sig, sec])
 
         self.tx_ins[input_index].script_sig = script_sig
+        self._changed()
 
         return self.verify_input(input_index)
 
+    def sign_inputs(self, private_key, input_indexes=None, hash_type=SIGHASH_ALL):
+        '''Signs several p2pkh inputs (all of them by default) with one
+        private key through PrivateKey.sign_many'''
+        if input_indexes is None:
+            input_indexes = range(len(self.tx_ins))
+        input_indexes = list(input_indexes)
+        zs = [self.sig_hash(i, hash_type=hash_type) for i in input_indexes]
+        sigs = private_key.sign_many(zs)
+        sec = private_key.point.sec()
+        for input_index, sig in zip(input_indexes, sigs):
+            der = sig.der() + hash_type.to_bytes(1, 'big')
+            self.tx_ins[input_index].script_sig = Script([der, sec])
+        self._changed()
+        return all(self.verify_input(i) for i in input_indexes)
+
     def is_coinbase(self):
 
 
@@ -383,6 +906,234 @@ class Tx:
         return little_endian_to_int(first_cmd)
 
 
+BLANK_OUTPUT = b'\xff' * 8 + b'\x00'
+
+
+class LegacySigHash:
+    '''The parts of every legacy signature hash preimage of one
+    transaction, serialized once. Each input's preimage is hashed
+    straight from these fragments.'''
+
+    def __init__(self, tx):
+        self.version = UINT32.pack(tx.version)
+        self.locktime = UINT32.pack(tx.locktime)
+        self.input_count = encode_varint(len(tx.tx_ins))
+        self.outpoints = []
+        self.sequences = []
+        blank_inputs = []
+        blank_inputs_no_sequence = []
+        for tx_in in tx.tx_ins:
+            outpoint = tx_in.prev_tx[::-1] + UINT32.pack(tx_in.prev_index)
+            sequence = UINT32.pack(tx_in.sequence)
+            self.outpoints.append(outpoint)
+            self.sequences.append(sequence)
+            # every input is 41 bytes once its script_sig is emptied
+            blank_inputs.append(outpoint + b'\x00' + sequence)
+            blank_inputs_no_sequence.append(outpoint + b'\x00' * 5)
+        self.blank_inputs = b''.join(blank_inputs)
+        self.blank_inputs_no_sequence = b''.join(blank_inputs_no_sequence)
+        self.outputs = [tx_out.serialize() for tx_out in tx.tx_outs]
+        self.all_outputs = encode_varint(len(self.outputs)) + b''.join(self.outputs)
+
+    def sig_hash(self, input_index, script_code, hash_type=SIGHASH_ALL):
+        '''script_code is the serialized script (with its length) that
+        takes the place of the signed input's script_sig'''
+        base_type = hash_type & 0x1f
+        if base_type == SIGHASH_SINGLE and input_index >= len(self.outputs):
+            # what the reference client signs when there is no matching output
+            return 1
+        h = sha256(self.version)
+        own = (self.outpoints[input_index], script_code,
+               self.sequences[input_index])
+        if hash_type & SIGHASH_ANYONECANPAY:
+            h.update(b'\x01')
+            for part in own:
+                h.update(part)
+        else:
+            if base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+                blank_inputs = memoryview(self.blank_inputs_no_sequence)
+            else:
+                blank_inputs = memoryview(self.blank_inputs)
+            h.update(self.input_count)
+            h.update(blank_inputs[:41 * input_index])
+            for part in own:
+                h.update(part)
+            h.update(blank_inputs[41 * (input_index + 1):])
+        if base_type == SIGHASH_NONE:
+            h.update(b'\x00')
+        elif base_type == SIGHASH_SINGLE:
+            h.update(encode_varint(input_index + 1))
+            h.update(BLANK_OUTPUT * input_index)
+            h.update(self.outputs[input_index])
+        else:
+            h.update(self.all_outputs)
+        h.update(self.locktime)
+        h.update(UINT32.pack(hash_type))
+        return int.from_bytes(sha256(h.digest()).digest(), 'big')
+
+
+def signature_hash_type(script_sig):
+    '''The hash type byte of the first DER signature in script_sig.
+    All signatures of one input are assumed to use the same type.'''
+    for cmd in script_sig.cmds:
+        if type(cmd) == bytes and len(cmd) > 8 and cmd[0] == 0x30:
+            return cmd[-1]
+    return SIGHASH_ALL
+
+
+class LazyTx(Tx):
+    '''A Tx that keeps its raw serialization. Parsing is a single scan that
+    only records where the inputs, outputs and witnesses are; TxIn and
+    TxOut objects are built the first time tx_ins or tx_outs is read.
+    While nothing has been changed, serialize(), hash() and id() work
+    directly from the original bytes.'''
+
+    def __init__(self, raw, layout, version, locktime, testnet=False, segwit=False):
+        self.raw = raw
+        # (offset of each input, outputs start, outputs end), where the
+        # outputs start at their count and witnesses follow outputs end
+        self.layout = layout
+        super().__init__(version, None, None, locktime, testnet=testnet, segwit=segwit)
+        self._original_header = (version, locktime, segwit, Script.generation)
+        self._modified = False
+
+    @property
+    def tx_ins(self):
+        if self._tx_ins is None:
+            self._tx_ins = self._build_inputs()
+        return self._tx_ins
+
+    @tx_ins.setter
+    def tx_ins(self, tx_ins):
+        self._tx_ins = tx_ins
+        self._changed()
+
+    @property
+    def tx_outs(self):
+        if self._tx_outs is None:
+            self._tx_outs = self._build_outputs()
+        return self._tx_outs
+
+    @tx_outs.setter
+    def tx_outs(self, tx_outs):
+        self._tx_outs = tx_outs
+        self._changed()
+
+    def _changed(self):
+        self._modified = True
+        super()._changed()
+
+    def is_modified(self):
+        '''Whether the raw bytes no longer match this transaction'''
+        if self._modified:
+            return True
+        header = (self.version, self.locktime, self.segwit, Script.generation)
+        if header == self._original_header:
+            return False
+        # a replaced cmds can only matter once inputs or outputs are built
+        if header[:3] != self._original_header[:3] or \
+                self._tx_ins is not None or self._tx_outs is not None:
+            self._modified = True
+        return self._modified
+
+    @classmethod
+    def parse_at(cls, buf, offset=0, testnet=False):
+        start = offset
+        version, = UINT32.unpack_from(buf, offset)
+        offset += 4
+        segwit = buf[offset] == 0
+        if segwit:
+            if buf[offset + 1] != 1:
+                raise RuntimeError('Not a segwit transaction {}'.format(
+                    bytes(buf[offset:offset + 2])))
+            offset += 2
+        num_inputs, offset = read_varint_at(buf, offset)
+        inputs = []
+        for _ in range(num_inputs):
+            inputs.append(offset - start)
+            length, offset = read_varint_at(buf, offset + 36)
+            offset += length + 4
+        outputs_start = offset - start
+        num_outputs, offset = read_varint_at(buf, offset)
+        for _ in range(num_outputs):
+            length, offset = read_varint_at(buf, offset + 8)
+            offset += length
+        outputs_end = offset - start
+        if segwit:
+            for _ in range(num_inputs):
+                num_items, offset = read_varint_at(buf, offset)
+                for _ in range(num_items):
+                    item_len, offset = read_varint_at(buf, offset)
+                    offset += item_len
+        locktime, = UINT32.unpack_from(buf, offset)
+        offset += 4
+        layout = (inputs, outputs_start, outputs_end)
+        raw = bytes(buf[start:offset])
+        return cls(raw, layout, version, locktime,
+                   testnet=testnet, segwit=segwit), offset
+
+    def _build_inputs(self):
+        raw = self.raw
+        offsets, _, witness_start = self.layout
+        inputs = []
+        for offset in offsets:
+            prev_tx = raw[offset:offset + 32][::-1]
+            prev_index, = UINT32.unpack_from(raw, offset + 32)
+            script_sig, offset = Script.parse_at(raw, offset + 36)
+            sequence, = UINT32.unpack_from(raw, offset)
+            inputs.append(TxIn(prev_tx, prev_index, script_sig, sequence))
+        if self.segwit:
+            offset = witness_start
+            for tx_in in inputs:
+                num_items, offset = read_varint_at(raw, offset)
+                items = []
+                for _ in range(num_items):
+                    item_len, offset = read_varint_at(raw, offset)
+                    if item_len == 0:
+                        items.append(0)
+                    else:
+                        items.append(raw[offset:offset + item_len])
+                        offset += item_len
+                tx_in.witness = items
+        return inputs
+
+    def _build_outputs(self):
+        raw = self.raw
+        _, offset, _ = self.layout
+        num_outputs, offset = read_varint_at(raw, offset)
+        outputs = []
+        for _ in range(num_outputs):
+            amount, = UINT64.unpack_from(raw, offset)
+            script_pubkey, offset = Script.parse_at(raw, offset + 8)
+            outputs.append(TxOut(amount, script_pubkey))
+        return outputs
+
+    def outpoints(self):
+        if self._tx_ins is not None:
+            return super().outpoints()
+        raw = self.raw
+        return [(raw[offset:offset + 32][::-1],
+                 UINT32.unpack_from(raw, offset + 32)[0])
+                for offset in self.layout[0]]
+
+    def _serialize(self, segwit):
+        if (segwit or not self.segwit) and not self.is_modified():
+            return self.raw
+        return super()._serialize(segwit)
+
+    def _serialize_into(self, buf, segwit):
+        if self.is_modified() or (segwit and not self.segwit):
+            super()._serialize_into(buf, segwit)
+        elif segwit or not self.segwit:
+            buf += self.raw
+        else:
+            # drop the marker, flag and witnesses
+            raw = memoryview(self.raw)
+            buf += raw[:4]
+            buf += raw[6:self.layout[2]]
+            buf += raw[-4:]
+
+
 class TxIn:
 
     def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff):
@@ -417,37 +1168,38 @@ class TxIn:
         return cls(prev_tx, prev_index, script_sig, sequence)
 
     def serialize(self):
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
 
+    def serialize_into(self, buf):
 
-        result = self.prev_tx[::-1]
 
-        result += int_to_little_endian(self.prev_index, 4)
+        buf += self.prev_tx[::-1]
 
-        result += self.script_sig.serialize()
+        buf += UINT32.pack(self.prev_index)
 
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        self.script_sig.serialize_into(buf)
+
+        buf += UINT32.pack(self.sequence)
 
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
 
-    def value(self, testnet=False):
-
-
-
-        tx = self.fetch_tx(testnet=testnet)
+    def prevout(self, testnet=False, prevouts=None):
+        '''The TxOut this input spends, taken from the prevouts map made by
+        resolve_prevouts when it has it'''
+        if prevouts is not None:
+            tx_out = prevouts.get((self.prev_tx, self.prev_index))
+            if tx_out is not None:
+                return tx_out
+        return self.fetch_tx(testnet=testnet).tx_outs[self.prev_index]
 
+    def value(self, testnet=False, prevouts=None):
+        return self.prevout(testnet, prevouts).amount
 
-        return tx.tx_outs[self.prev_index].amount
-
-    def script_pubkey(self, testnet=False):
-
-
-
-        tx = self.fetch_tx(testnet=testnet)
-
-
-        return tx.tx_outs[self.prev_index].script_pubkey
+    def script_pubkey(self, testnet=False, prevouts=None):
+        return self.prevout(testnet, prevouts).script_pubkey
 
 
 class TxOut:
@@ -471,11 +1223,81 @@ class TxOut:
         return cls(amount, script_pubkey)
 
     def serialize(self):
-
-
-        result = int_to_little_endian(self.amount, 8)
-
-        result += self.script_pubkey.serialize()
-        return result
-
-
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+
+
+        buf += UINT64.pack(self.amount)
+
+        self.script_pubkey.serialize_into(buf)
+
+
+def resolve_prevouts(txs, testnet=None):
+    '''Maps (prev_tx, prev_index) of every input of txs to the TxOut it
+    spends. Outputs of earlier transactions in txs are used directly, as
+    in a block; every other previous transaction is fetched once, all of
+    them in one TxFetcher.fetch_many call.'''
+    if testnet is None:
+        testnet = bool(txs) and txs[0].testnet
+    prevouts = {}
+    in_list = {}
+    missing = {}
+    for tx in txs:
+        if not tx.is_coinbase():
+            for tx_in in tx.tx_ins:
+                source = in_list.get(tx_in.prev_tx)
+                if source is not None:
+                    prevouts[(tx_in.prev_tx, tx_in.prev_index)] = \
+                        source.tx_outs[tx_in.prev_index]
+                else:
+                    missing.setdefault(tx_in.prev_tx, []).append(tx_in.prev_index)
+        if len(txs) > 1:
+            in_list[tx.hash()] = tx
+    fetched = TxFetcher.fetch_many(
+        [prev_tx.hex() for prev_tx in missing], testnet=testnet)
+    for (prev_tx, prev_indexes), prev in zip(missing.items(), fetched):
+        for prev_index in prev_indexes:
+            prevouts[(prev_tx, prev_index)] = prev.tx_outs[prev_index]
+    return prevouts
+
+
+def verify_inputs_batch(tx_inputs, prevouts=None):
+    '''Takes a list of (tx, input_index) and returns whether all of them
+    verify. The signature checks of every input are collected and run
+    through a single verify_batch call. An input whose deferred checks
+    fail is evaluated again without batching, so the answer is always
+    the same as calling verify_input on each one.'''
+    if prevouts is None:
+        txs = list({id(tx): tx for tx, _ in tx_inputs}.values())
+        prevouts = resolve_prevouts(txs)
+    # the BIP143 midstate of each segwit tx, taken once
+    midstates = {}
+    for tx, _ in tx_inputs:
+        if tx.segwit and id(tx) not in midstates:
+            midstates[id(tx)] = tx._bip143_midstate()
+    deferred = []
+    spans = []
+    for tx, input_index in tx_inputs:
+        start = len(deferred)
+        midstate = midstates.get(id(tx))
+        if tx.verify_input(input_index, deferred, prevouts, midstate):
+            spans.append((tx, input_index, start, len(deferred), midstate))
+        else:
+            del deferred[start:]
+            if not tx.verify_input(input_index, prevouts=prevouts, midstate=midstate):
+                return False
+    start = perf_counter()
+    results = verify_batch(deferred)
+    if ScriptProfiler.active is not None:
+        ScriptProfiler.active.record('signature', 'verify_batch', perf_counter() - start)
+    for item, valid in zip(deferred, results):
+        if valid:
+            SIG_CACHE.add(*item)
+    for tx, input_index, start, end, midstate in spans:
+        if not all(results[start:end]) and \
+                not tx.verify_input(input_index, prevouts=prevouts, midstate=midstate):
+            return False
+    return True